@@ -0,0 +1,363 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark repub.py on the pages in benchmarks/corpus: time spent in each stage of the conversion, throughput,
+peak memory, and a check that the extracted text matches the golden output (so speedups do not change results).
+
+    python benchmarks/bench.py -o results.json
+    python benchmarks/bench.py --compare before.json after.json
+    python benchmarks/bench.py --update-golden   # after an intended change of the extracted text
+"""
+import sys
+import os
+import argparse
+import collections
+import gzip
+import json
+import logging
+import multiprocessing
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import gc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+import repub
+
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, "corpus")
+GOLDEN_DIR = os.path.join(BENCHMARK_DIR, "golden")
+REGRESSIONS_DIR = os.path.join(BENCHMARK_DIR, "regressions")  # small pages only checked against golden output
+RESULTS_FORMAT = 1  # bumped when the layout of the results file changes
+REPEAT = 5  # each stage is timed this many times, the best and the median time are reported
+PARSER_BACKEND = "html.parser"  # golden output is recorded with this one, available everywhere
+REGRESSION_THRESHOLD = 10.0  # percent - --compare fails when a stage gets slower than this
+STAGES = ("preprocess", "parse", "extract", "package", "total")
+# preprocess - stripping scripts/styles and prefiltering the source (preprocessDocumentSource, prefilterDocumentSource)
+# parse - building the tree (makeSoup)
+# extract - metadata, selection of the main section and extraction of content blocks
+# package - writing the EPUB from extracted blocks
+# total - whole conversion as done by the command line (generateEPUB, content streamed into the package)
+CONVERSION_OPTIONS = dict(includeDIV=repub.INCLUDE_DIV, includeIMG=False, includeTables=repub.INCLUDE_TABLES)
+
+
+def corpusDocuments(names=None, corpusDir=CORPUS_DIR):
+    """
+    RETURNS:
+        list[tuple] - (name, path) of corpus documents, sorted by name
+    """
+    documents = []
+    for filename in sorted(os.listdir(corpusDir)):
+        name = filename[:-3] if filename.endswith(".gz") else filename
+        name, extension = os.path.splitext(name)
+        if extension.lower() in (".html", ".htm") and (not names or name in names):
+            documents.append((name, os.path.join(corpusDir, filename)))
+    return documents
+
+
+def readDocument(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as documentFile:
+        return documentFile.read()
+
+
+def peakMemoryKB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on Linux
+
+
+def goldenPath(name, parserBackend, group=""):
+    return os.path.join(GOLDEN_DIR, parserBackend, group, name + ".json")
+
+
+def extractDocument(documentData, blocks):
+    """
+    RETURNS:
+        dict - extracted text compared with golden output
+    """
+    return {"title": documentData.title, "author": documentData.author, "blocks": [unicode(block) for block in blocks]}
+
+
+def checkGolden(name, parserBackend, extracted, update=False, group=""):
+    """
+    RETURNS:
+        str - "ok", "changed", "missing" (no golden output for the document/parser) or "updated"
+    """
+    path = goldenPath(name, parserBackend, group)
+    if update:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as goldenFile:
+            json.dump(extracted, goldenFile, indent=1, sort_keys=True)
+            goldenFile.write("\n")
+        return "updated"
+    try:
+        with open(path, "rb") as goldenFile:
+            golden = json.load(goldenFile)
+    except IOError:
+        return "missing"
+    return "ok" if golden == extracted else "changed"
+
+
+class StageTimer(object):
+    """
+    Wraps repub functions to measure time (and peak memory) of the stages they belong to.
+    """
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.peakMemory = {}
+        self.recordMemory = True
+        self._originals = []
+
+    def wrap(self, owner, attrName, stage):
+        original = getattr(owner, attrName)
+        def wrapper(*args, **kwargs):
+            startTime = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.times[stage] += time.time() - startTime
+                if self.recordMemory:
+                    self.peakMemory[stage] = peakMemoryKB()
+        self._originals.append((owner, attrName, original))
+        setattr(owner, attrName, wrapper)
+
+    def reset(self):
+        self.times.clear()
+
+    def restore(self):
+        for owner, attrName, original in reversed(self._originals):
+            setattr(owner, attrName, original)
+        self._originals = []
+
+
+def benchmarkDocument(job):
+    """
+    Benchmark one document. Runs in a fresh worker process, so that peak memory is not affected by
+    other documents.
+    ARGS:
+        job (tuple) - (name, path, parserBackend, repeat, updateGolden)
+    RETURNS:
+        tuple - (name, result dict)
+    """
+    name, path, parserBackend, repeat, updateGolden = job
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, "w")  # repub prints removed sections
+    sourceDocument = readDocument(path)
+    outDir = tempfile.mkdtemp(prefix="repub-bench-")
+    timer = StageTimer()
+    timer.wrap(repub.DocumentData, "preprocessDocumentSource", "preprocess")
+    timer.wrap(repub.DocumentData, "prefilterDocumentSource", "preprocess")
+    timer.wrap(repub, "makeSoup", "parse")
+    gc.collect()
+    baseMemory = peakMemoryKB()
+    samples = collections.defaultdict(list)
+    extracted = None
+    try:
+        for _ in xrange(repeat):
+            timer.reset()
+            gc.collect()
+            startTime = time.time()
+            documentData = repub.DocumentData(parserBackend=parserBackend, deterministic=True)
+            documentData.loadDocument(sourceDocument, **CONVERSION_OPTIONS)
+            blocks = list(documentData.iterContentBlocks())
+            extractTime = time.time() - startTime - timer.times["preprocess"] - timer.times["parse"]
+            for stage in ("preprocess", "parse"):
+                samples[stage].append(timer.times[stage])
+            if timer.recordMemory:
+                timer.peakMemory["extract"] = peakMemoryKB()
+            if extracted is None:
+                extracted = extractDocument(documentData, blocks)
+
+            startTime = time.time()
+            package = repub.ZipPackage(os.path.join(outDir, "package.epub"),
+                                       timestamp=documentData.conversionTimestamp)
+            repub.initializePackageStructure(package)
+            chapters = repub.generateContent(package, documentData, blocks)
+            repub.generateTocNcx(package, documentData, chapters)
+            repub.generateContentOpf(package, documentData, {}, chapters)
+            repub.generateCSS(package, documentData)
+            package.close()
+            packageTime = time.time() - startTime
+            if timer.recordMemory:
+                timer.peakMemory["package"] = peakMemoryKB()
+            del blocks, documentData
+            recordMemory, timer.recordMemory = timer.recordMemory, False
+
+            startTime = time.time()
+            repub.generateEPUB(None, sourceDocument, outDir, outputFilename="total.epub", deterministic=True,
+                               parserBackend=parserBackend, **CONVERSION_OPTIONS)
+            samples["total"].append(time.time() - startTime)
+            if recordMemory:
+                timer.peakMemory["total"] = peakMemoryKB()
+            samples["extract"].append(extractTime)
+            samples["package"].append(packageTime)
+    finally:
+        timer.restore()
+        shutil.rmtree(outDir, ignore_errors=True)
+
+    megabytes = len(sourceDocument) / 1024.0 / 1024.0
+    stages = {}
+    for stage in STAGES:
+        times = sorted(samples[stage])
+        stages[stage] = {"best": round(times[0], 6), "median": round(times[len(times) / 2], 6),
+                         "mbPerSec": round(megabytes / times[0], 3) if times[0] else None}
+    result = {
+        "bytes": len(sourceDocument),
+        "blocks": len(extracted["blocks"]),
+        "golden": checkGolden(name, parserBackend, extracted, update=updateGolden),
+        "stages": stages,
+        "peakMemoryKB": dict((stage, max(0, timer.peakMemory.get(stage, baseMemory) - baseMemory)) for stage in STAGES),
+    }
+    return name, result
+
+
+def checkRegressions(parserBackend=PARSER_BACKEND, updateGolden=False):
+    """
+    Convert the pages in benchmarks/regressions (cases that once broke extraction) and compare the extracted
+    text with golden output.
+    RETURNS:
+        dict - {name: golden status}
+    """
+    statuses = {}
+    stdout = sys.stdout
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, "w")  # repub prints removed sections
+    try:
+        for name, path in corpusDocuments(corpusDir=REGRESSIONS_DIR):
+            documentData = repub.DocumentData(parserBackend=parserBackend, deterministic=True)
+            documentData.loadDocument(readDocument(path), **CONVERSION_OPTIONS)
+            extracted = extractDocument(documentData, documentData.iterContentBlocks())
+            statuses[name] = checkGolden(name, parserBackend, extracted, update=updateGolden, group="regressions")
+    finally:
+        sys.stdout = stdout
+        logging.disable(logging.NOTSET)
+    for name in sorted(statuses):
+        print "%-40s golden: %s" % (name, statuses[name])
+    return statuses
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCHMARK_DIR,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(names=None, parserBackend=PARSER_BACKEND, repeat=REPEAT, updateGolden=False):
+    """
+    RETURNS:
+        dict - results (see README, "Benchmarks")
+    """
+    documents = corpusDocuments(names)
+    results = {
+        "format": RESULTS_FORMAT,
+        "repubVersion": repub.__version__,
+        "commit": gitCommit(),
+        "python": sys.version.split()[0],
+        "beautifulsoup": repub.bs4.__version__,
+        "parser": parserBackend,
+        "repeat": repeat,
+        "documents": {},
+        "regressions": checkRegressions(parserBackend, updateGolden),
+    }
+    for name, path in documents:
+        pool = multiprocessing.Pool(processes=1)
+        try:
+            name, result = pool.apply(benchmarkDocument, [(name, path, parserBackend, repeat, updateGolden)])
+        finally:
+            pool.terminate()
+            pool.join()
+        results["documents"][name] = result
+        printDocumentResult(name, result)
+    return results
+
+
+def printDocumentResult(name, result):
+    print "%-16s %8d KB %5d blocks  golden: %s" % (name, result["bytes"] / 1024, result["blocks"], result["golden"])
+    for stage in STAGES:
+        timing = result["stages"][stage]
+        print "    %-10s best %9.4fs  median %9.4fs %9.2f MB/s  peak memory +%d KB" % (
+            stage, timing["best"], timing["median"], timing["mbPerSec"] or 0, result["peakMemoryKB"][stage])
+
+
+def compareResults(baseResults, newResults, threshold=REGRESSION_THRESHOLD):
+    """
+    Print change of the best time of every stage of every document.
+    RETURNS:
+        list[str] - regressions (stages slower by more than threshold percent, changed golden output)
+    """
+    regressions = []
+    if baseResults.get("parser") != newResults.get("parser"):
+        print "warning: results were measured with different parsers (%s, %s)" % (baseResults.get("parser"),
+                                                                                  newResults.get("parser"))
+    print "%-16s %-10s %10s %10s %8s" % ("document", "stage", "before", "after", "change")
+    for name, status in sorted(newResults.get("regressions", {}).items()):
+        if status == "changed":
+            regressions.append("regressions/%s: extracted text differs from golden output" % name)
+    for name in sorted(newResults["documents"]):
+        newResult = newResults["documents"][name]
+        if newResult["golden"] == "changed":
+            regressions.append("%s: extracted text differs from golden output" % name)
+        baseResult = baseResults["documents"].get(name)
+        if baseResult is None:
+            continue
+        for stage in STAGES:
+            before = baseResult["stages"].get(stage, {}).get("best")
+            after = newResult["stages"].get(stage, {}).get("best")
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            flag = ""
+            if change > threshold:
+                flag = " <-- slower"
+                regressions.append("%s/%s: %+.1f%%" % (name, stage, change))
+            print "%-16s %-10s %9.4fs %9.4fs %+7.1f%%%s" % (name, stage, before, after, change, flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("documents", nargs="*", help="names of corpus documents to run (default: all)")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("-n", "--repeat", help="number of timed runs per document (default: %d)" % REPEAT, type=int,
+                        default=REPEAT)
+    parser.add_argument("--parser", help="HTML parser backend (default: %s)" % PARSER_BACKEND, default=PARSER_BACKEND,
+                        choices=repub.PARSER_BACKENDS)
+    parser.add_argument("--update-golden", help="record the extracted text as the new golden output",
+                        action="store_true", default=False)
+    parser.add_argument("--compare", help="compare two results files instead of running benchmarks", nargs=2,
+                        metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--threshold", help="max. slowdown of a stage accepted by --compare (percent, default: %s)"
+                        % REGRESSION_THRESHOLD, type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], "rb") as baseFile:
+            baseResults = json.load(baseFile)
+        with open(args.compare[1], "rb") as newFile:
+            newResults = json.load(newFile)
+        regressions = compareResults(baseResults, newResults, args.threshold)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        sys.exit(1 if regressions else 0)
+
+    if args.parser not in repub.availableParserBackends():
+        print >> sys.stderr, "parser backend not installed: %s" % args.parser
+        sys.exit(1)
+    unknownNames = set(args.documents) - set(name for name, _ in corpusDocuments())
+    if unknownNames:
+        print >> sys.stderr, "no such corpus documents: %s" % ", ".join(sorted(unknownNames))
+        sys.exit(1)
+    results = runBenchmarks(args.documents, args.parser, max(1, args.repeat), args.update_golden)
+    if args.output:
+        with open(args.output, "wb") as outputFile:
+            json.dump(results, outputFile, indent=1, sort_keys=True)
+            outputFile.write("\n")
+    changed = [name for name, result in results["documents"].items() if result["golden"] == "changed"]
+    changed += ["regressions/%s" % name for name, status in results["regressions"].items() if status == "changed"]
+    if changed:
+        print >> sys.stderr, "extracted text differs from golden output: %s" % ", ".join(sorted(changed))
+        sys.exit(1)
@@ -3,6 +3,8 @@ repub.py - extract text from websites to EPUB files.
 Copyright (c) 2014, Maciej Borowik (https://github.com/macborow).
 Released under MIT license (see bottom of the file)
 """
+__version__ = "1.1"
+
 import sys
 import os
 import tempfile
@@ -13,14 +15,44 @@ import logging
 import uuid
 import zipfile
 import string
-import shutil
 import urllib2
 import BaseHTTPServer
+import SocketServer
+import signal
 import re
 import cookielib
 import cgi
-from urlparse import urlparse
+import glob
+import multiprocessing
+import traceback
+import httplib
+import socket
+import threading
+import time
+import Queue
+import zlib
+import StringIO
+import HTMLParser
+import textwrap
+import json
+import hashlib
+import collections
+import itertools
+import mmap
+import email
+import shutil
+from urlparse import urlparse, urljoin, parse_qs
+from multiprocessing.pool import ThreadPool
 from xml.sax.saxutils import quoteattr
+from xml.etree import ElementTree
+try:
+    from PIL import Image  # optional, needed only to downscale and recompress images (--img-optimize)
+except ImportError:
+    Image = None
+try:
+    import fcntl  # not available on Windows, where updates from concurrent processes may be lost
+except ImportError:
+    fcntl = None
 
 URL=""
 
@@ -30,6 +62,17 @@ INCLUDE_TABLES = False
 ENABLE_STRIPPING = True  # strip only selected sections (e.g. article, etc.) - try to narrow down to only interesting content
 STRIP_JAVASCRIPT = True  # attempt to remove <script> tags from source document before parsing, some javascript code causes problems with BS4
 STRIP_STYLE = True # attempt to remove <style> tags before parsing, some CSS syntax causes issues with BS4
+STRIP_EXTRA_TAGS = []  # other tags to be removed (with their content) before parsing, e.g. ["noscript", "svg"]
+RAW_TEXT_TAGS = ("script", "style")  # contents are not HTML - the first closing tag ends the element, no nesting
+PARSER_BACKEND = "auto"  # BeautifulSoup tree builder: "lxml", "html.parser", "html5lib" or "auto" (fastest one installed)
+PARSER_BACKENDS = ["lxml", "html.parser", "html5lib"]  # fastest first
+REPUB_HOME = os.path.join(os.path.expanduser("~"), ".repub")  # persistent caches are kept here
+DETERMINISTIC_BUILD = False  # same input gives byte-identical book: identifier derived from the source, fixed dates (see buildTimestamp)
+PREFILTER_DOCUMENT = True  # drop comments, scripts and excluded sections while streaming the source, before the tree is built
+DETECT_CONTENT_ROOT = True  # if no content selector matches, pick the element with most paragraph text as the main section
+CONTENT_ROOT_MIN_TEXT = 500  # min. length of paragraph text (in characters) in an element picked as the main section
+CONTENT_ROOT_MIN_SHARE = 0.5  # ... and min. fraction of all paragraph text in the document it has to contain
+CONTENT_ROOT_CHILD_SHARE = 0.8  # the search goes down into a child only if it holds this fraction of its parent's paragraph text
 
 # NOTE: special font schemes for Sony PRS-T1 reader - .ttf files should be copied to READER:/fonts/
 FONT_SCHEMES = {
@@ -110,21 +153,756 @@ EXTRA_CSS = [
 ]
 
 MAX_LINE_LEN = 46  # for splitting long lines in <pre> targs
+DEVICE_RESOLUTION = (600, 800)  # Sony PRS-T1 screen, with --img-optimize images are downscaled to fit
+IMAGE_JPEG_QUALITY = 70  # used when recompressing photos with --img-optimize
+IMAGE_PNG_COLORS = 16  # e-ink screens show 16 shades of gray, more colors only make the images bigger
+
+# some blogs define section id="content", let's try to be smart about it
+CONTENT_SELECTORS = [
+    {"name": "article", "role": "main"},
+    {"name": "section", "class": "main_cont"},
+    {"name": "div", "id": "sn-content"},
+    {"name": "div", "id": "content"},
+    {"name": "div", "data-zone": "contentSection"},
+    #{"name": "div", "class": "content"},
+    {"name": "div", "class": "contentbox"},
+    {"name": "section", "id": "content"},
+    {"name": "div", "id": "maincontent"},
+    {"name": "div", "id": "main-content"},
+    {"name": "div", "class": "main-content"},
+    {"name": "div", "class": "single-archive"},
+    {"name": "div", "class": "blogcontent"},
+    {"name": "div", "class": "post"},
+    {"name": "div", "class": "hentry"},
+    {"name": "div", "class": "article-single-container"},
+    {"name": "div", "id": "story-content"},
+    #~ {"name": "div", "class": "col-left-story"},
+]
+
+EXCLUDED_CONTENT_SELECTORS = [
+    {"name": "div", "class": "more-from"},
+    {"name": "div", "class": "more-in-this-section"},
+    {"name": "div", "class": "breaking-stories"},
+    {"name": "ul", "data-vr-zone": "most-read-stories"},
+    {"name": "div", "id": "topstories"},
+    {"name": "div", "id": "mostshared"},
+    {"name": "div", "class": "blog-archive-list"},
+    {"name": "div", "id": "stb-header"},
+    {"name": "ul", "class": "navigation-list"},
+    {"name": "ul", "class": "tag-list"},
+    {"name": "ul", "class": "mainNav"},
+    {"name": "div", "class": "secLinks"},
+    {"name": "div", "id": "tmg-related-links"},
+    {"name": "div", "class": "related_links"},
+    {"name": "div", "class": "section-puffs"},
+    {"name": "div", "class": "artCommercial"},
+    {"name": "div", "class": "mostPopular"},
+    {"name": "div", "class": "PageList"},
+    {"name": "div", "class": "BlogArchive"},
+    {"name": "ul", "class": "menu1"},
+    {"name": "ul", "class": "menu2"},
+    {"name": "div", "bucket-id": "top_stories_05"},
+    {"name": "div", "class": "printHide"},
+    {"name": "aside", "class": "related-coverage-marginalia"},
+    {"name": "aside", "class": "collection-theme-latest-headlines"},
+    {"name": "div", "class": "m-site-nav"},
+    {"name": "div", "id": "top-line-navigation"},
+    {"name": "div", "id": "primary-navigation"},
+    {"name": "nav"},
+    {"name": "div", "class": "topics_holder"},
+]
+
+# site rules: <host>.json files with selectors for pages from one site, e.g. siterules/www.example.com.json:
+# {"contentSelectors": [{"name": "div", "class": "article-body"}],
+#  "excludedContentSelectors": [{"name": "aside"}],
+#  "useGenericRules": false}  (true - CONTENT_SELECTORS and EXCLUDED_CONTENT_SELECTORS are tried as well)
+# a file for example.com is used for all its subdomains unless they have their own, later directories take precedence
+SITE_RULES_DIRS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "siterules"),
+    os.path.join(REPUB_HOME, "siterules"),
+]
+
+def stripTags(sourceDocument, tagNames):
+    """
+    Strip all content between <tagName ...> and </tagName> for all given tags in a single pass over the document.
+    Nested elements are matched properly (except for RAW_TEXT_TAGS which cannot be nested),
+    unclosed elements are left for the parser to deal with and stray closing tags are dropped.
+    Comments are left untouched, tags inside them are not matched.
+    ARGS:
+        sourceDocument (str)
+        tagNames (list[str]) - should not include < and >
+    RETURNS:
+        str - document without the stripped elements
+    """
+    tagRegexp = re.compile(r"<!--.*?-->|<\s*(/?)\s*(%s)\b[^>]*?(/?)>" % "|".join(re.escape(tagName) for tagName in tagNames),
+                           re.I | re.S)
+    output = []
+    copiedUntil = 0
+    openTagName = None  # element being stripped
+    openTagStart = 0
+    depth = 0
+    strippedCount = dict((tagName.lower(), 0) for tagName in tagNames)
+    for match in tagRegexp.finditer(sourceDocument):
+        if match.group(2) is None:
+            continue  # comment - copied as it is (or stripped together with the element around it)
+        isClosing, tagName, isSelfClosing = bool(match.group(1)), match.group(2).lower(), bool(match.group(3))
+        if openTagName is None:
+            if isClosing or isSelfClosing:
+                # stray closing tag or an empty element, e.g. <script src="..."/> - drop just the tag
+                output.append(sourceDocument[copiedUntil:match.start()])
+                copiedUntil = match.end()
+                strippedCount[tagName] += 1
+            else:
+                openTagName, openTagStart, depth = tagName, match.start(), 1
+        elif tagName == openTagName:
+            if isClosing:
+                depth -= 1
+            elif not isSelfClosing and tagName not in RAW_TEXT_TAGS:
+                depth += 1
+            if depth == 0:
+                output.append(sourceDocument[copiedUntil:openTagStart])
+                copiedUntil = match.end()
+                openTagName = None
+                strippedCount[tagName] += 1
+        # everything else inside stripped element goes away together with it
+    if openTagName is not None:
+        logging.warn("Unclosed <%s> tag - leaving it in the document", openTagName)
+    output.append(sourceDocument[copiedUntil:])
+    for tagName, count in sorted(strippedCount.items()):
+        if count:
+            logging.info("Stripped %s <%s> tags from source document", count, tagName)
+    return "".join(output)
+
+
+VOID_ELEMENTS = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "meta", "param",
+                           "source", "track", "wbr"])
+MULTI_VALUED_ATTRIBUTES = frozenset(["class", "rel", "rev", "accept-charset", "headers", "accesskey", "dropzone"])
+
+def selectorMatches(selector, tagName, attrs):
+    """
+    Check if element matches selector the same way soup.find_all(**selector) would.
+    ARGS:
+        selector (dict) - "name" and attribute values, e.g. {"name": "div", "class": "post"}
+        tagName (str)
+        attrs (dict) - attribute values, multi-valued attributes (class) can be given as strings or lists
+    """
+    for attrName, expectedValue in selector.items():
+        if attrName == "name":
+            if tagName != expectedValue:
+                return False
+            continue
+        value = attrs.get(attrName)
+        if value is None:
+            return False
+        if attrName in MULTI_VALUED_ATTRIBUTES:
+            values = value.split() if isinstance(value, basestring) else value
+            if expectedValue not in values and expectedValue != " ".join(values):
+                return False
+        elif value != expectedValue:
+            return False
+    return True
+
+
+class SelectorIndex(object):
+    """
+    Selector list compiled into a lookup table keyed by tag name and the value of one attribute (id or class
+    if present), so elements can be matched against all selectors at once instead of running soup.find_all
+    separately for each of them.
+    """
+
+    def __init__(self, selectors):
+        """
+        ARGS:
+            selectors (list[dict]) - see CONTENT_SELECTORS
+        """
+        self.selectors = list(selectors)
+        self._index = {}  # tag name (None - any tag) -> attribute name (None - no attributes) -> value -> [selector idx]
+        for idx, selector in enumerate(self.selectors):
+            attrNames = sorted(attrName for attrName in selector if attrName != "name")
+            keyAttrName = None
+            for attrName in ["id", "class"] + attrNames:
+                if attrName in attrNames:
+                    keyAttrName = attrName
+                    break
+            attrIndex = self._index.setdefault(selector.get("name"), {})
+            valueIndex = attrIndex.setdefault(keyAttrName, {})
+            valueIndex.setdefault(selector[keyAttrName] if keyAttrName else None, []).append(idx)
+
+    def __len__(self):
+        return len(self.selectors)
+
+    def matches(self, tagName, attrs):
+        """
+        ARGS:
+            tagName (str)
+            attrs (dict) - attribute values, see selectorMatches
+        RETURNS:
+            list[int] - indices of matching selectors in ascending order
+        """
+        found = []
+        for tagKey in (tagName, None):
+            attrIndex = self._index.get(tagKey)
+            if not attrIndex:
+                continue
+            for attrName, valueIndex in attrIndex.items():
+                if attrName is None:
+                    keys = (None,)
+                else:
+                    value = attrs.get(attrName)
+                    if value is None:
+                        continue
+                    if attrName in MULTI_VALUED_ATTRIBUTES:
+                        values = value.split() if isinstance(value, basestring) else value
+                        keys = set(values)
+                        keys.add(" ".join(values))
+                    else:
+                        keys = (value,)
+                for key in keys:
+                    for idx in valueIndex.get(key, ()):
+                        if selectorMatches(self.selectors[idx], tagName, attrs):
+                            found.append(idx)
+        if len(found) > 1:
+            found = sorted(set(found))
+        return found
+
+
+def findSelectorMatches(root, *selectorIndexes):
+    """
+    Find elements matching selectors from all given indexes in a single walk over the tree.
+    ARGS:
+        root (bs4.Tag) - only descendants of the root are matched (like in root.find_all)
+        selectorIndexes (SelectorIndex)
+    RETURNS:
+        list[list[tuple]] - for each index (selector idx, element) pairs ordered by selector idx and then by
+                            position in the document, i.e. the order of running find_all for each selector in turn
+    """
+    results = [[] for _ in selectorIndexes]
+    for element in root.descendants:
+        if not isinstance(element, bs4.Tag):
+            continue
+        for selectorIndex, result in zip(selectorIndexes, results):
+            for idx in selectorIndex.matches(element.name, element.attrs):
+                result.append((idx, element))
+    for result in results:
+        result.sort(key=lambda match: match[0])  # stable - keeps document order within each selector
+    return results
+
+
+class SiteRules(object):
+    """
+    Content selectors used for pages from one site. Selector indexes are built on first use and shared by all
+    documents from the site.
+    """
+
+    def __init__(self, name, contentSelectors, excludedContentSelectors, digest=""):
+        """
+        ARGS:
+            name (str) - host the rules were loaded for, "generic" for the built-in ones
+            contentSelectors (list[dict]) - see CONTENT_SELECTORS
+            excludedContentSelectors (list[dict]) - see EXCLUDED_CONTENT_SELECTORS
+            digest (str) - identifies the contents of the rule file, "" for the built-in rules
+        """
+        self.name = name
+        self.contentSelectors = list(contentSelectors)
+        self.excludedContentSelectors = list(excludedContentSelectors)
+        self.digest = digest
+        self._contentIndex = None
+        self._excludedIndex = None
+
+    @property
+    def contentIndex(self):
+        if self._contentIndex is None:
+            self._contentIndex = SelectorIndex(self.contentSelectors)
+        return self._contentIndex
+
+    @property
+    def excludedIndex(self):
+        if self._excludedIndex is None:
+            self._excludedIndex = SelectorIndex(self.excludedContentSelectors)
+        return self._excludedIndex
+
+
+def siteHost(url):
+    """
+    RETURNS:
+        str - lowercase host name without port, None if url has none
+    """
+    if not url:
+        return None
+    try:
+        host = urlparse(url).hostname
+    except Exception:
+        return None
+    return host.lower().rstrip(".") if host else None
+
+
+OG_URL_META_REGEXP = re.compile(r"""<meta\s[^>]*?property\s*=\s*["']og:url["'][^>]*>""", re.I)
+META_CONTENT_REGEXP = re.compile(r"""\scontent\s*=\s*(?:"([^"]*)"|'([^']*)')""", re.I)
+
+def findDocumentURL(sourceDocument):
+    """
+    Find page address in og:url meta tag without parsing the document.
+    RETURNS:
+        str - URL or None
+    """
+    metaTag = OG_URL_META_REGEXP.search(sourceDocument)
+    if not metaTag:
+        return None
+    content = META_CONTENT_REGEXP.search(metaTag.group(0))
+    if not content:
+        return None
+    return (content.group(1) or content.group(2) or "").strip() or None
+
+
+class SiteRulesRegistry(object):
+    """
+    Site rules indexed by host. Rule files are read only when a page from their site is converted for the first
+    time and kept for the life of the process, hosts without rules get the generic ones.
+    """
+
+    def __init__(self, ruleDirs=None):
+        """
+        ARGS:
+            ruleDirs (list[str]) - directories with <host>.json files, SITE_RULES_DIRS if not provided
+        """
+        self.ruleDirs = list(SITE_RULES_DIRS if ruleDirs is None else ruleDirs)
+        self.genericRules = SiteRules("generic", CONTENT_SELECTORS, EXCLUDED_CONTENT_SELECTORS)
+        self._rules = {}  # host -> SiteRules
+        self._lock = threading.Lock()
+
+    def rulesFor(self, url):
+        """
+        ARGS:
+            url (str) - page address, may be None
+        RETURNS:
+            SiteRules
+        """
+        host = siteHost(url)
+        if not host:
+            return self.genericRules
+        with self._lock:
+            rules = self._rules.get(host)
+            if rules is None:
+                rules = self._rules[host] = self._findRules(host)
+        return rules
+
+    def _findRules(self, host):
+        labels = [host] if re.match(r"^[\d.:]+$", host) else host.split(".")  # no parent domains for IP addresses
+        for start in xrange(max(len(labels) - 1, 1)):
+            domain = ".".join(labels[start:])
+            if start and domain in self._rules:
+                return self._rules[domain]
+            rules = self._loadRules(domain)
+            if rules is not None:
+                logging.info("Using site rules for %s", domain)
+                return rules
+        return self.genericRules
+
+    def _loadRules(self, domain):
+        """
+        RETURNS:
+            SiteRules - None if there is no valid rule file for the domain
+        """
+        for ruleDir in reversed(self.ruleDirs):
+            path = os.path.join(ruleDir, domain + ".json")
+            try:
+                with open(path, "rb") as ruleFile:
+                    data = ruleFile.read()
+            except IOError:
+                continue
+            try:
+                config = json.loads(data)
+                contentSelectors = self._checkSelectors(config.get("contentSelectors", []))
+                excludedSelectors = self._checkSelectors(config.get("excludedContentSelectors", []))
+            except (ValueError, AttributeError), ex:
+                logging.warn("Ignoring invalid site rules %s: %s", path, ex)
+                continue
+            if config.get("useGenericRules"):
+                contentSelectors += [selector for selector in CONTENT_SELECTORS if selector not in contentSelectors]
+                excludedSelectors += [selector for selector in EXCLUDED_CONTENT_SELECTORS
+                                      if selector not in excludedSelectors]
+            return SiteRules(domain, contentSelectors, excludedSelectors, hashlib.sha1(data).hexdigest())
+        return None
+
+    def _checkSelectors(self, selectors):
+        if not isinstance(selectors, list) or not all(
+                isinstance(selector, dict) and selector and
+                all(isinstance(value, basestring) for value in selector.values()) for selector in selectors):
+            raise ValueError("selectors have to be a list of objects with string values")
+        return [dict((str(key), value) for key, value in selector.items()) for selector in selectors]
+
+
+SITE_RULES = SiteRulesRegistry()
+
+
+class DocumentPrefilter(HTMLParser.HTMLParser):
+    """
+    Event based pass over the source document which copies only the markup worth building a tree from.
+    Comments, <script>/<style> elements and elements matching excluded selectors are dropped while streaming,
+    so BeautifulSoup has to build (and keep in memory) a much smaller tree for big pages.
+    Excluded elements containing potential main content (content selectors) are kept, so that content selection
+    works the same way as without the filter.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, excludedSelectors=None, protectedSelectors=None):
+        """
+        ARGS:
+            excludedSelectors (list[dict] or SelectorIndex)
+            protectedSelectors (list[dict] or SelectorIndex) - content selectors
+        """
+        HTMLParser.HTMLParser.__init__(self)
+        self.excludedSelectors = self._selectorIndex(excludedSelectors)
+        self.protectedSelectors = self._selectorIndex(protectedSelectors)
+        self.output = []
+        self.openTags = []  # names of currently open elements
+        self.droppedCount = 0
+        self._excludedDepth = None  # len(self.openTags) when inside excluded element, None otherwise
+        self._excludedOutput = []  # markup of the excluded element, restored if it turns out to contain main content
+
+    @staticmethod
+    def _selectorIndex(selectors):
+        return selectors if isinstance(selectors, SelectorIndex) else SelectorIndex(selectors or [])
+
+    def filter(self, sourceDocument):
+        """
+        RETURNS:
+            str - filtered document
+        """
+        for offset in xrange(0, len(sourceDocument), self.CHUNK_SIZE):
+            self.feed(sourceDocument[offset:offset + self.CHUNK_SIZE])
+        self.close()
+        if self._excludedDepth is not None:
+            self._keepExcludedElement()  # never closed - better keep it than lose the rest of the document
+        return "".join(self.output)
+
+    def unescape(self, value):
+        return value  # attribute values are only used for matching, no need to decode entities
+
+    def _write(self, markup):
+        if self._excludedDepth is None:
+            self.output.append(markup)
+        else:
+            self._excludedOutput.append(markup)
+
+    def _keepExcludedElement(self):
+        self.output.extend(self._excludedOutput)
+        self._excludedOutput = []
+        self._excludedDepth = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in RAW_TEXT_TAGS:
+            self.openTags.append(tag)
+            return
+        attrs = dict((name, value or "") for name, value in attrs)
+        if self._excludedDepth is not None:
+            if self.protectedSelectors.matches(tag, attrs):
+                self._keepExcludedElement()
+        elif self.excludedSelectors.matches(tag, attrs) and not self.protectedSelectors.matches(tag, attrs):
+            # an element matching both kinds of selectors may be the main content - never exclude it
+            if tag in VOID_ELEMENTS:
+                self.droppedCount += 1
+                return
+            self._excludedDepth = len(self.openTags) + 1
+        self._write(self.get_starttag_text())
+        if tag not in VOID_ELEMENTS:
+            self.openTags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in RAW_TEXT_TAGS:
+            return
+        attrs = dict((name, value or "") for name, value in attrs)
+        if (self._excludedDepth is None and self.excludedSelectors.matches(tag, attrs)
+                and not self.protectedSelectors.matches(tag, attrs)):
+            self.droppedCount += 1
+            return
+        self._write(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if tag not in self.openTags:
+            if tag not in RAW_TEXT_TAGS:
+                self._write("</%s>" % tag)  # stray closing tag, let the parser deal with it
+            return
+        position = len(self.openTags) - 1 - self.openTags[::-1].index(tag)
+        del self.openTags[position:]
+        if tag in RAW_TEXT_TAGS:
+            return
+        if self._excludedDepth is not None and position < self._excludedDepth:
+            # excluded element is closed - either by its own closing tag or by closing one of its parents
+            closingTagOfExcludedElement = position == self._excludedDepth - 1
+            self._excludedOutput = []
+            self._excludedDepth = None
+            self.droppedCount += 1
+            if closingTagOfExcludedElement:
+                return
+        self._write("</%s>" % tag)
+
+    def handle_data(self, data):
+        if self.openTags and self.openTags[-1] in RAW_TEXT_TAGS:
+            return
+        self._write(data)
+
+    def handle_entityref(self, name):
+        self._write("&%s;" % name)
+
+    def handle_charref(self, name):
+        self._write("&#%s;" % name)
+
+    def handle_comment(self, data):
+        pass
+
+    def handle_decl(self, decl):
+        self._write("<!%s>" % decl)
+
+    def unknown_decl(self, data):
+        self._write("<![%s]>" % data)
+
+    def handle_pi(self, data):
+        self._write("<?%s>" % data)
+
+
+TEXT_NODE_TYPES = (bs4.NavigableString, bs4.CData)  # string types included in getText(), unlike comments, doctype, etc.
+HEADING_TAG_REGEXP = re.compile(r"h\d")
+CONTENT_PARAGRAPH_TAGS = frozenset(["p", "pre", "blockquote"])
+
+class ContentBlock(unicode):
+    """
+    XHTML markup of a single paragraph/headline/image, which also remembers what it was made from.
+    """
+
+    def __new__(cls, markup, tagName=None, text=None):
+        """
+        ARGS:
+            markup (unicode)
+            tagName (str) - name of the source element
+            text (unicode) - plain text of the block
+        """
+        block = unicode.__new__(cls, markup)
+        block.tagName = tagName
+        block.text = text
+        return block
+
+
+def splitTextAtLineBreaks(element):
+    """
+    Split text of the element into passages separated by <br> tags, taking the strings straight from the tree.
+    ARGS:
+        element (bs4.Tag)
+    RETURNS:
+        list[unicode] - text of each passage (not stripped, can be empty)
+    """
+    passages = [[]]
+    for descendant in element.descendants:
+        if isinstance(descendant, bs4.Tag):
+            if descendant.name == "br":
+                passages.append([])
+        elif type(descendant) in TEXT_NODE_TYPES:
+            passages[-1].append(descendant)
+    return [u"".join(passage) for passage in passages]
+
+
+
+class ContentScores(object):
+    """
+    Text statistics of every element in the tree (text length, length of link text, length of paragraph text),
+    computed in a single bottom-up pass, used for picking the main section of the document.
+    """
+
+    def __init__(self, root):
+        """
+        ARGS:
+            root (bs4.Tag)
+        """
+        self.root = root
+        self.textLength = {}  # id(element) -> length of all text inside
+        self.linkLength = {}  # id(element) -> length of text inside <a> tags
+        self.paragraphTextLength = {}  # id(element) -> length of non-link text in paragraphs directly inside
+        self.subtreeParagraphTextLength = {}  # id(element) -> length of non-link text in all paragraphs inside
+        nodes = [root]
+        nodes.extend(root.descendants)
+        textLength, linkLength = self.textLength, self.linkLength
+        subtreeParagraphTextLength = self.subtreeParagraphTextLength
+
+        # paragraphs inside other paragraphs (e.g. <p> in <blockquote>) are counted as part of the outer one
+        nestedParagraphs = set()
+        for element in nodes[1:]:
+            if isinstance(element, bs4.Tag):
+                parent = element.parent
+                if id(parent) in nestedParagraphs or (parent is not root and parent.name in CONTENT_PARAGRAPH_TAGS):
+                    nestedParagraphs.add(id(element))
+
+        for element in reversed(nodes):
+            parentKey = id(element.parent)
+            if not isinstance(element, bs4.Tag):
+                if type(element) in TEXT_NODE_TYPES:
+                    textLength[parentKey] = textLength.get(parentKey, 0) + len(element.strip())
+                continue
+            # all children have been visited already (reversed document order)
+            key = id(element)
+            elementTextLength = textLength.setdefault(key, 0)
+            if element.name == "a":
+                linkLength[key] = elementTextLength
+            elementLinkLength = linkLength.setdefault(key, 0)
+            elementParagraphTextLength = (subtreeParagraphTextLength.get(key, 0) +
+                                          self.paragraphTextLength.get(key, 0))
+            subtreeParagraphTextLength[key] = elementParagraphTextLength
+            if element is root:
+                break
+            if element.name in CONTENT_PARAGRAPH_TAGS and key not in nestedParagraphs:
+                self.paragraphTextLength[parentKey] = (self.paragraphTextLength.get(parentKey, 0) +
+                                                       elementTextLength - elementLinkLength)
+            textLength[parentKey] = textLength.get(parentKey, 0) + elementTextLength
+            linkLength[parentKey] = linkLength.get(parentKey, 0) + elementLinkLength
+            subtreeParagraphTextLength[parentKey] = (subtreeParagraphTextLength.get(parentKey, 0) +
+                                                     elementParagraphTextLength)
+
+    def score(self, element):
+        """
+        RETURNS:
+            int - length of readable (non-link) text inside the element
+        """
+        return self.textLength.get(id(element), 0) - self.linkLength.get(id(element), 0)
+
+    def bestCandidate(self, candidates):
+        """
+        RETURNS:
+            bs4.Tag - candidate with the highest score (the first one in case of a tie)
+        """
+        bestElement = None
+        for candidate in candidates:
+            if bestElement is None or self.score(candidate) > self.score(bestElement):
+                bestElement = candidate
+        return bestElement
+
+    def bestRoot(self, minTextLength=CONTENT_ROOT_MIN_TEXT, minShare=CONTENT_ROOT_MIN_SHARE,
+                 childShare=CONTENT_ROOT_CHILD_SHARE):
+        """
+        Find the smallest element containing most of the paragraph text, for documents not matching any
+        of the content selectors. Goes down from the root as long as a single child holds almost all the paragraph
+        text of its parent, so an article split into several sections is kept whole.
+        RETURNS:
+            bs4.Tag or None - if there is no element containing enough of the text
+        """
+        textLength = self.subtreeParagraphTextLength
+        totalParagraphTextLength = textLength.get(id(self.root), 0)
+        bestElement = self.root
+        while True:
+            children = [child for child in bestElement.children if isinstance(child, bs4.Tag)]
+            if not children:
+                break
+            bestChild = max(children, key=lambda child: textLength.get(id(child), 0))
+            if textLength.get(id(bestChild), 0) < childShare * textLength.get(id(bestElement), 0) or \
+                    not textLength.get(id(bestChild), 0):
+                break
+            bestElement = bestChild
+        bestTextLength = textLength.get(id(bestElement), 0)
+        if bestElement is self.root or bestTextLength < minTextLength or \
+                bestTextLength < minShare * totalParagraphTextLength:
+            return None
+        return bestElement
+
+
+def availableParserBackends():
+    """
+    RETURNS:
+        list[str] - installed parser backends, fastest first
+    """
+    return [backend for backend in PARSER_BACKENDS if bs4.builder.builder_registry.lookup(backend) is not None]
+
+
+def makeSoup(markup, backend=None, fallback=True):
+    """
+    Build the document tree with given parser backend. If the backend is not installed or fails to parse the document
+    other installed backends are tried.
+    ARGS:
+        markup (str)
+        backend (str) - see PARSER_BACKEND
+        fallback (bool) - try other backends on failure
+    RETURNS:
+        bs4.BeautifulSoup
+    """
+    backend = backend or PARSER_BACKEND
+    backends = availableParserBackends()
+    if backend != "auto":
+        backends = [backend] + [otherBackend for otherBackend in backends if otherBackend != backend]
+    if not fallback:
+        backends = backends[:1]
+    for idx, candidate in enumerate(backends):
+        try:
+            return bs4.BeautifulSoup(markup, candidate)
+        except Exception, ex:
+            if idx == len(backends) - 1:
+                raise
+            logging.warn("Parser backend %s failed (%s: %s), trying %s", candidate, ex.__class__.__name__, ex, backends[idx + 1])
+
+
+def compareParserBackends(sourceDocument, url=None, includeDIV=False, includeIMG=False, includeTables=False, repeat=3):
+    """
+    Convert the document with every installed parser backend to see which one is the fastest
+    (and whether they extract the same text) for a given site.
+    RETURNS:
+        list[tuple] - (backend, best time in seconds, number of paragraphs, text length) for each backend
+    """
+    results = []
+    for backend in availableParserBackends():
+        bestTime = None
+        for _ in range(repeat):
+            documentData = DocumentData(url, parserBackend=backend)
+            startTime = time.time()
+            documentData.parseDocument(sourceDocument, includeDIV=includeDIV, includeIMG=includeIMG, includeTables=includeTables)
+            elapsed = time.time() - startTime
+            bestTime = elapsed if bestTime is None else min(bestTime, elapsed)
+        results.append((backend, bestTime, len(documentData.paragraphs), len(documentData.documentBody)))
+    return results
+
+
+def sourceUUID(url, sourceDigest):
+    """
+    RETURNS:
+        str - book identifier derived from the source (instead of a random one) in deterministic mode
+    """
+    url = url.encode("utf-8") if isinstance(url, unicode) else url or ""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "%s#%s" % (url, sourceDigest)))
+
+
+def buildTimestamp():
+    """
+    Date put in books in deterministic mode.
+    RETURNS:
+        datetime.datetime - from SOURCE_DATE_EPOCH environment variable (see reproducible-builds.org) if set,
+                            1980-01-01 (the earliest date zip files can store) otherwise
+    """
+    sourceDateEpoch = os.environ.get("SOURCE_DATE_EPOCH", "")
+    if sourceDateEpoch.isdigit():
+        return datetime.datetime.utcfromtimestamp(int(sourceDateEpoch))
+    return datetime.datetime(1980, 1, 1)
+
 
 class DocumentData(object):
-    def __init__(self, url=None):
-        self.conversionTimestamp = datetime.datetime.now()
-        self.shortDateString = self.conversionTimestamp.strftime("%Y-%m-%d")
+    def __init__(self, url=None, parserBackend=None, imagePrefix="", deterministic=False, boilerplateIndex=None):
+        self.deterministic = deterministic  # see DETERMINISTIC_BUILD
+        self.boilerplateIndex = boilerplateIndex  # BoilerplateIndex, None - keep all paragraphs
+        now = datetime.datetime.now()
+        self.conversionTimestamp = buildTimestamp() if deterministic else now
+        self.shortDateString = self.conversionTimestamp.strftime("%Y-%m-%d")  # date put in the book
+        self.fileDateString = now.strftime("%Y-%m-%d")  # date put in the output file name, the real one in any mode
         self.uuid = str(uuid.uuid1())
         self.title = "Untitled"
         self.author = "Unknown"
         self.url = url or ""
         self.language = "en"
+        self.parserBackend = parserBackend or PARSER_BACKEND
+        self.imagePrefix = imagePrefix  # added to local image names, keeps them unique when many documents share a book
 
         self.paragraphs = []
         self.documentBody = ""
         self.templateValues = {}
         self.images = []
+        self.contentRoot = None  # main section of the document selected by loadDocument
+        self.siteRules = None  # SiteRules for the document's site, set by loadDocument
+        self.documentKey = None  # identifies the document in the boilerplate index, set by loadDocument
+        self.allowedTags = []
+        self.includeIMG = False
 
 
     def getAllowedParagraphTagNames(self, includeDIV=False, includeIMG=False, includeTables=False):
@@ -138,51 +916,92 @@ class DocumentData(object):
             tags.append("table")
         return tags
 
+    def imagePlaceholder(self, localName):
+        return "<img src=%s/>" % quoteattr("../img/%s" % localName)
+
+    def removeImages(self, localNames):
+        """
+        Drop images (e.g. the ones that could not be downloaded) together with their <img> tags in the text.
+        ARGS:
+            localNames (list[str]) - names assigned to the images by processImage
+        """
+        localNames = set(localNames)
+        if not localNames:
+            return
+        placeholders = set(self.imagePlaceholder(localName) for localName in localNames)
+        self.images = [image for image in self.images if image[0] not in localNames]
+        self.paragraphs = [paragraph for paragraph in self.paragraphs if paragraph not in placeholders]
+        self.documentBody = u"\n".join(self.paragraphs)
+        self.templateValues["documentBody"] = self.documentBody
+
+    def renameImages(self, newNames):
+        """
+        Change local names of images (e.g. after they have been converted to another format).
+        ARGS:
+            newNames (dict) - old local name -> new local name
+        """
+        if not newNames:
+            return
+        placeholders = dict((self.imagePlaceholder(oldName), self.imagePlaceholder(newName))
+                            for oldName, newName in newNames.items())
+        self.images = [[newNames.get(localName, localName), url] for localName, url in self.images]
+        self.paragraphs = [placeholders.get(paragraph, paragraph) for paragraph in self.paragraphs]
+        self.documentBody = u"\n".join(self.paragraphs)
+        self.templateValues["documentBody"] = self.documentBody
+
     def preprocessDocumentSource(self, sourceDocument):
         """
         Before parsing strip some elements that are not handled well by BeautifulSoup.
         """
-        def stripTags(tagName, sourceDocument):
-            """
-            Attempt to strip all content between <tagName ...> and </tagName>.
-            ARGS:
-                tagName (str) - should not include < and >
-            """
-            openingTag = r"<\s*%s.*?[^/]*?>" % tagName
-            closingTag = r"<\s*?/%s\s*?>" % tagName
-            startIdx = [m.start(0) for m in re.finditer(openingTag, sourceDocument)]
-            endIdx = [m.end(0) for m in re.finditer(closingTag, sourceDocument)]
-            if len(startIdx) != len(endIdx):
-                logging.warn("Number of opening and closing <%s> tags does not match: %s/%s",
-                             tagName, len(startIdx), len(endIdx))
-            else:
-                startIdx.reverse()
-                endIdx.reverse()
-                # additional consistency check
-                for idx in range(len(startIdx)):
-                    if endIdx[idx] < startIdx[idx]:
-                        break
-                else:
-                    # remove the matching text
-                    # TODO: this is not the most memory efficient way to do it, good enough for now
-                    for idx in range(len(startIdx)):
-                        sourceDocument = sourceDocument[:startIdx[idx]] + sourceDocument[endIdx[idx]:]
-                    logging.info("Stripped %s <%s> tags from source document", len(startIdx), tagName)
-            return sourceDocument
-
+        tagNames = list(STRIP_EXTRA_TAGS)
         if STRIP_JAVASCRIPT:
             # attempt strip all scripts from document
-            sourceDocument = stripTags("script", sourceDocument)
+            tagNames.append("script")
         if STRIP_STYLE:
-            sourceDocument = stripTags("style", sourceDocument)
-        return sourceDocument
+            tagNames.append("style")
+        if not tagNames:
+            return sourceDocument
+        return stripTags(sourceDocument, tagNames)
 
 
+    def prefilterDocumentSource(self, sourceDocument):
+        """
+        Prune the document before the tree is built (see DocumentPrefilter).
+        """
+        if not PREFILTER_DOCUMENT:
+            return sourceDocument
+        rules = self.siteRules or SITE_RULES.genericRules
+        prefilter = DocumentPrefilter(excludedSelectors=rules.excludedIndex if ENABLE_STRIPPING else [],
+                                      protectedSelectors=rules.contentIndex if ENABLE_STRIPPING else [])
+        try:
+            filteredDocument = prefilter.filter(sourceDocument)
+        except Exception, ex:
+            logging.warn("Prefiltering failed, parsing the whole document: %s", ex)
+            return sourceDocument
+        logging.info("Prefilter: %d -> %d bytes, %d sections dropped", len(sourceDocument), len(filteredDocument),
+                     prefilter.droppedCount)
+        return filteredDocument
+
     def parseDocument(self, sourceDocument, includeDIV=False, includeIMG=False, includeTables=False):
         """
+        Load the document and extract all of its content into self.paragraphs.
+        sourceDocument (str) - input file contents
+        """
+        self.loadDocument(sourceDocument, includeDIV=includeDIV, includeIMG=includeIMG, includeTables=includeTables)
+        self.paragraphs = list(self.iterContentBlocks())
+        self.documentBody = u"\n".join(self.paragraphs)
+        self.templateValues["documentBody"] = self.documentBody
+
+    def loadDocument(self, sourceDocument, includeDIV=False, includeIMG=False, includeTables=False):
+        """
+        Parse the document, read its metadata and select the main section. The content is extracted
+        later by iterContentBlocks.
         sourceDocument (str) - input file contents
         """
-        soup = bs4.BeautifulSoup(self.preprocessDocumentSource(sourceDocument))
+        if self.deterministic:
+            self.uuid = sourceUUID(self.url, hashlib.sha1(sourceDocument).hexdigest())
+        self.siteRules = SITE_RULES.rulesFor(self.url or findDocumentURL(sourceDocument))
+        soup = makeSoup(self.prefilterDocumentSource(self.preprocessDocumentSource(sourceDocument)), self.parserBackend)
         
         title = soup.find("title")
         if title and title.string:
@@ -205,6 +1024,10 @@ class DocumentData(object):
                 except Exception:
                     pass
         logging.info("AUTHOR: %s", self.author)
+        if self.boilerplateIndex is not None:
+            # the same page converted again (even if it has changed) must not count as another document
+            documentId = self.url.encode("utf-8") if self.url else sourceDocument
+            self.documentKey = hashlib.sha1(documentId).hexdigest()[:16]
 
         # strip all comments
         for comment in soup.findAll(text=lambda tag: isinstance(tag, bs4.Comment)):
@@ -214,85 +1037,61 @@ class DocumentData(object):
         for scriptTag in soup.findAll("script"):
             scriptTag .extract()
 
-        # text passages containing <br> tags into multiple paragraphs
-        brSplitRegexp = re.compile(r"\<\s*br\s*/{0,1}\>", re.I)
-
-        # some blogs define section id="content", let's try to be smart about it
-        contentSelectors = [
-            {"name": "article", "role": "main"},
-            {"name": "section", "class": "main_cont"},
-            {"name": "div", "id": "sn-content"},
-            {"name": "div", "id": "content"},
-            {"name": "div", "data-zone": "contentSection"},
-            #{"name": "div", "class": "content"},
-            {"name": "div", "class": "contentbox"},
-            {"name": "section", "id": "content"},
-            {"name": "div", "id": "maincontent"},
-            {"name": "div", "id": "main-content"},
-            {"name": "div", "class": "main-content"},
-            {"name": "div", "class": "single-archive"},
-            {"name": "div", "class": "blogcontent"},
-            {"name": "div", "class": "post"},
-            {"name": "div", "class": "hentry"},
-            {"name": "div", "class": "article-single-container"},
-            {"name": "div", "id": "story-content"},
-            #~ {"name": "div", "class": "col-left-story"},
-        ]
         contentCandidates = []
         if ENABLE_STRIPPING:
-            for selector in contentSelectors:
-                contentSections = soup.find_all(**selector)
-                if contentSections:
-                    contentCandidates.extend(contentSections)
+            contentMatches, excludedMatches = findSelectorMatches(soup, self.siteRules.contentIndex,
+                                                                  self.siteRules.excludedIndex)
+            contentCandidates = [element for _, element in contentMatches]
         
-        # select the largest section from the ones filtered out above
+        # select the section with most text from the ones filtered out above
         if contentCandidates:
-            soup = ""
-            for contentCandidate in contentCandidates:
-                if len(str(contentCandidate)) > len(str(soup)):
-                    soup = contentCandidate
+            soup = ContentScores(soup).bestCandidate(contentCandidates)
             logging.info("Stripping everything except for the following section: %s %s", soup.name, repr(soup.attrs))
+        elif ENABLE_STRIPPING and DETECT_CONTENT_ROOT:
+            contentRoot = ContentScores(soup).bestRoot()
+            if contentRoot is not None:
+                soup = contentRoot
+                logging.info("No content selector matched, using section with most text: %s %s", soup.name, repr(soup.attrs))
 
-        excludedContentSelectors = [
-            {"name": "div", "class": "more-from"},
-            {"name": "div", "class": "more-in-this-section"},
-            {"name": "div", "class": "breaking-stories"},
-            {"name": "ul", "data-vr-zone": "most-read-stories"},
-            {"name": "div", "id": "topstories"},
-            {"name": "div", "id": "mostshared"},
-            {"name": "div", "class": "blog-archive-list"},
-            {"name": "div", "id": "stb-header"},
-            {"name": "ul", "class": "navigation-list"},
-            {"name": "ul", "class": "tag-list"},
-            {"name": "ul", "class": "mainNav"},
-            {"name": "div", "class": "secLinks"},
-            {"name": "div", "id": "tmg-related-links"},
-            {"name": "div", "class": "related_links"},
-            {"name": "div", "class": "section-puffs"},
-            {"name": "div", "class": "artCommercial"},
-            {"name": "div", "class": "mostPopular"},
-            {"name": "div", "class": "PageList"},
-            {"name": "div", "class": "BlogArchive"},
-            {"name": "ul", "class": "menu1"},
-            {"name": "ul", "class": "menu2"},
-            {"name": "div", "bucket-id": "top_stories_05"},
-            {"name": "div", "class": "printHide"},
-            {"name": "aside", "class": "related-coverage-marginalia"},
-            {"name": "aside", "class": "collection-theme-latest-headlines"},
-            {"name": "div", "class": "m-site-nav"},
-            {"name": "div", "id": "top-line-navigation"},
-            {"name": "div", "id": "primary-navigation"},
-            {"name": "nav"},
-            {"name": "div", "class": "topics_holder"},
-        ]
         if ENABLE_STRIPPING:
-            for selector in excludedContentSelectors:
-                contentSections = soup.find_all(**selector)
-                if contentSections:
-                    print "Removing section:", selector
-                    for section in contentSections:
-                        section.extract()
+            reportedSelectorIdx = None
+            for selectorIdx, section in excludedMatches:
+                # only sections inside the selected one which have not been removed together with their parent yet
+                if not any(parent is soup for parent in section.parents):
+                    continue
+                if selectorIdx != reportedSelectorIdx:
+                    print "Removing section:", self.siteRules.excludedContentSelectors[selectorIdx]
+                    reportedSelectorIdx = selectorIdx
+                section.extract()
+
+        self.contentRoot = soup
+        self.allowedTags = self.getAllowedParagraphTagNames(includeDIV, includeIMG, includeTables)
+        self.includeIMG = includeIMG
+        self.templateValues = self.makeTemplateValues()
+
+    def makeTemplateValues(self):
+        """
+        RETURNS:
+            dict - document metadata escaped for use in templates
+        """
+        return {
+            "title": cgi.escape(self.title),
+            "url": cgi.escape(self.url),
+            "urlAttribute": quoteattr(self.url),
+            "author": cgi.escape(self.author),
+            "shortDateString": self.shortDateString,
+            "uuid": self.uuid,
+            "language": self.language,
+        }
 
+    def iterContentBlocks(self):
+        """
+        Extract content of the document loaded by loadDocument block by block, so it can be written out without
+        keeping the whole text in memory. Images found on the way are added to self.images.
+        Can be consumed only once, the tree is released at the end.
+        RETURNS:
+            iterator[ContentBlock] - paragraphs, headlines and image placeholders
+        """
         imageCache = {}
         def processImage(imgTag, imgCounter=[0]):
             imgUrl = None
@@ -306,7 +1105,7 @@ class DocumentData(object):
                 if imgUrl in imageCache:
                     localName = imageCache[imgUrl]
                 else:
-                    localName = "%s%s" % (str(imgCounter[0]), os.path.splitext(imgUrl.split("?")[0])[1])
+                    localName = "%s%s%s" % (self.imagePrefix, str(imgCounter[0]), os.path.splitext(imgUrl.split("?")[0])[1])
                     imageUrl = imgTag[srcAttrName]
                     if imageUrl.startswith("/"):
                         try:
@@ -321,12 +1120,20 @@ class DocumentData(object):
                             imageUrl = "%s%s" % (hostUrl, imageUrl)
                     self.images.append([localName, imageUrl])
                     imageCache[imgUrl] = localName
-                self.paragraphs.append("<img src=%s/>" % quoteattr("../img/%s" % localName))
                 imgCounter[0] += 1
+                return self.imagePlaceholder(localName)
+
+        # paragraphs seen in many other documents from the same site are skipped
+        host = siteHost(self.url) if self.boilerplateIndex is not None else None
+        boilerplate = self.boilerplateIndex.knownBlocks(host) if host else None
+        fingerprints = set()
+        droppedCount = 0
 
         # extract what looks like text/headlines
-        allowedTags = self.getAllowedParagraphTagNames(includeDIV, includeIMG, includeTables)
-        for paragraph in soup.find_all(allowedTags):
+        allowedTags = self.allowedTags
+        includeIMG = self.includeIMG
+        lastBlock = None
+        for paragraph in self.contentRoot.find_all(allowedTags):
             # try to skip nested DIVs
             if paragraph.name == 'div':
                 # look only at DIVs containing text directly, so they don't get picked up multiple times if the div contains another divs...
@@ -345,12 +1152,14 @@ class DocumentData(object):
                 # make sure not included twice, e.g. <strong> inside <p>
                 continue
 
+            imgTags = []
             if paragraph.getText():
-                for content in brSplitRegexp.split(unicode(paragraph)):
-                    content = bs4.BeautifulSoup(content).getText().strip()
+                # text passages containing <br> tags into multiple paragraphs
+                for content in splitTextAtLineBreaks(paragraph):
+                    content = content.strip()
                     if content:
                         newContent = None
-                        if re.match("h\\d", paragraph.name):
+                        if HEADING_TAG_REGEXP.match(paragraph.name):
                             newContent = u"<%s>%s</%s>" % (paragraph.name, cgi.escape(content), paragraph.name)
                         if paragraph.name in ("pre", "li", "blockquote"):
                             paragraphname = paragraph.name
@@ -358,40 +1167,47 @@ class DocumentData(object):
                                 paragraphname = 'pre'  # use formatting as for source code
                             if paragraphname == 'pre':
                                 # wrap long lines (that my Sony PRS-T1 cannot wrap inside <pre> tags)
-                                import textwrap
                                 content = '\n'.join(textwrap.wrap(content, MAX_LINE_LEN))
                             newContent = u"<%s>%s</%s>" % (paragraphname, cgi.escape(content), paragraphname)
                         elif paragraph.name == "img":
-                            processImage(paragraph)
+                            newContent = processImage(paragraph)
                         elif paragraph.name == "table":
                             newContent = unicode(paragraph)
                         else:
                             newContent = u"<p>%s</p>" % cgi.escape(content)
-                        if newContent and (not self.paragraphs or newContent != self.paragraphs[-1]):  # ignore duplicates
-                            self.paragraphs.append(newContent)
+                        if newContent and newContent != lastBlock:  # ignore duplicates
+                            if boilerplate is not None and newContent.startswith(u"<p>") and \
+                                    not HEADING_TAG_REGEXP.match(paragraph.name) and \
+                                    len(content) >= BOILERPLATE_MIN_TEXT:
+                                fingerprint = blockFingerprint(content)
+                                fingerprints.add(fingerprint)
+                                if fingerprint in boilerplate:
+                                    droppedCount += 1
+                                    continue
+                            lastBlock = newContent
+                            yield ContentBlock(newContent, paragraph.name, content)
             elif includeIMG and paragraph.name == "img":
-                processImage(paragraph)
+                imgTags.append(paragraph)
             if includeIMG:
                 # handle images within paragraph
-                for imgTag in paragraph.find_all("img"):
-                    processImage(imgTag)
+                imgTags.extend(paragraph.find_all("img"))
                 if paragraph.name == 'figure':
-                    for imgTag in paragraph.find_all('div'):
-                        if 'data-src' in imgTag.attrs:
-                            processImage(imgTag)
+                    imgTags.extend(imgTag for imgTag in paragraph.find_all('div') if 'data-src' in imgTag.attrs)
+            for imgTag in imgTags:
+                placeholder = processImage(imgTag)
+                if placeholder:
+                    lastBlock = placeholder
+                    yield ContentBlock(placeholder, "img")
 
-        self.documentBody = u"\n".join(self.paragraphs)
-        
-        self.templateValues = {
-            "title": cgi.escape(self.title),
-            "url": cgi.escape(self.url),
-            "urlAttribute": quoteattr(self.url),
-            "author": cgi.escape(self.author),
-            "shortDateString": self.shortDateString,
-            "uuid": self.uuid,
-            "language": self.language,
-            "documentBody": self.documentBody
-        }
+        self.contentRoot = None
+        if boilerplate is not None:
+            if droppedCount:
+                logging.info("Dropped %d paragraphs seen in other documents from %s", droppedCount, host)
+            fingerprints.discard(None)
+            try:
+                self.boilerplateIndex.record(host, self.documentKey, fingerprints)
+            except (IOError, OSError), ex:
+                logging.warn("Could not update boilerplate index: %s", ex)
 
 
 CONTAINER_XML = (
@@ -420,12 +1236,7 @@ ur"""<?xml version="1.0" encoding="UTF-8" ?>
 	</docAuthor>
 
 	<navMap>
-		<navPoint class="section" id="navPoint-1" playOrder="1">
-			<navLabel>
-				<text>Content</text>
-			</navLabel>
-			<content src="text/content.xhtml"/>
-		</navPoint>
+%(navPoints)s
 	</navMap>
 </ncx>
 """)
@@ -447,17 +1258,26 @@ ur"""<?xml version="1.0" encoding="UTF-8" ?>
 	</metadata>
 	<manifest>
 		<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
-		<item id="content" href="text/content.xhtml" media-type="application/xhtml+xml"/>
+%(contentManifestItems)s
+%(imageManifestItems)s
 	</manifest>
 	<spine toc="ncx">
-		<itemref idref="content" linear="yes"/>
+%(spineItems)s
 	</spine>
 	<guide>
-		<reference type="text" title="Content" href="text/content.xhtml"/>
+		<reference type="text" title="Content" href="text/%(startFileName)s"/>
 	</guide>
 </package>
 """)
 
+NAV_POINT_TEMPLATE = (
+ur"""		<navPoint class="section" id="navPoint-%(playOrder)d" playOrder="%(playOrder)d">
+			<navLabel>
+				<text>%(label)s</text>
+			</navLabel>
+			<content src="text/%(fileName)s"/>
+		</navPoint>""")
+
 CONTENT_TEMPLATE = (
 ur"""<?xml version="1.0" encoding="UTF-8" ?>
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
@@ -475,87 +1295,2037 @@ ur"""<?xml version="1.0" encoding="UTF-8" ?>
 </html>
 """)
 
-def initializePackageStructure(tmpDir):
-    os.mkdir(os.path.join(tmpDir, "META-INF"))
-    os.mkdir(os.path.join(tmpDir, "OEBPS"))
-    os.mkdir(os.path.join(tmpDir, "OEBPS", "text"))
-    os.mkdir(os.path.join(tmpDir, "OEBPS", "img"))
-    with open(os.path.join(tmpDir, "mimetype"), "wb") as fileOut:
-        fileOut.write("application/epub+zip")
-    with open(os.path.join(tmpDir, "META-INF", "container.xml"), "wb") as fileOut:
-        fileOut.write(CONTAINER_XML)
+# following chapters of a document split into multiple files, without the document header
+CHAPTER_TEMPLATE = (
+ur"""<?xml version="1.0" encoding="UTF-8" ?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+<head>
+  <title>%(title)s</title>
+  <link rel="stylesheet" type="text/css" href="content.css"/>
+</head>
 
+<body>
+%(documentBody)s
+</body>
+</html>
+""")
 
-def generateTocNcx(tmpDir, documentData):
-    with open(os.path.join(tmpDir, "OEBPS", "toc.ncx"), "wb") as tf:
-        tf.write(TOC_NCX_TEMPLATE % documentData.templateValues)
+CHAPTER_MAX_BYTES = 256 * 1024  # content is split into files of at most this size (approximately), some readers choke on bigger ones (0 - no splitting)
+CHAPTER_MIN_BYTES = 16 * 1024  # new file is started at a headline only if the current one is at least this big
+CHAPTER_HEADING_TAGS = ("h1", "h2")  # headlines starting new chapters
 
+class DirectoryPackage(object):
+    """
+    EPUB parts written to a directory tree (debug mode - files can be inspected, saveAsEPUB zips them afterwards).
+    """
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+        self._writtenNames = []
 
-def generateContentOpf(tmpDir, documentData):
-    with open(os.path.join(tmpDir, "OEBPS", "content.opf"), "wb") as tf:
-        tf.write(CONTENT_OPF_TEMPLATE % documentData.templateValues)
+    def writeFile(self, name, data):
+        """
+        ARGS:
+            name (str) - path inside the package, e.g. "OEBPS/toc.ncx"
+            data (str)
+        """
+        self.writeChunks(name, [data])
 
+    def writeChunks(self, name, chunks):
+        """
+        ARGS:
+            name (str) - path inside the package
+            chunks (iterable[str]) - file contents
+        """
+        path = os.path.join(self.rootDir, *name.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._writtenNames.append(name)
+        with open(path, "wb") as fileOut:
+            for chunk in chunks:
+                fileOut.write(chunk)
 
-def generateContent(tmpDir, documentData):
-    content = CONTENT_TEMPLATE % documentData.templateValues
-    with open(os.path.join(tmpDir, "OEBPS", "text", "content.xhtml"), "wb") as tf:
-        tf.write(content.encode("utf-8"))
+    def checkpoint(self):
+        """
+        RETURNS:
+            object - state of the package to go back to with rollback()
+        """
+        return len(self._writtenNames)
 
+    def rollback(self, checkpoint):
+        """
+        Remove parts written since the checkpoint was taken.
+        """
+        for name in self._writtenNames[checkpoint:]:
+            path = os.path.join(self.rootDir, *name.split("/"))
+            if os.path.exists(path):
+                os.remove(path)
+        del self._writtenNames[checkpoint:]
 
-def generateCSS(tmpDir, documentData, extraCSS=None):
-    if extraCSS is None:
-        extraCSS = []
-    content = "\n".join(extraCSS)
-    with open(os.path.join(tmpDir, "OEBPS", "text", "content.css"), "wb") as tf:
-        tf.write(content.encode("utf-8"))
+    def close(self):
+        pass
 
 
-def downloadImages(tmpDir, documentData):
-    for (localName, url) in documentData.images:
-        try:
-            logging.info("Downloading image: %s", url)
-            imgRequest = urllib2.Request(url)
-            try:
-                imgData = urllib2.urlopen(imgRequest).read()
-                with open(os.path.join(tmpDir, "OEBPS", "img", localName), "wb") as imgFile:
-                    imgFile.write(imgData)
-            except urllib2.HTTPError, ex:
-                logging.error("Failed to download image: %s", ex.message)
-        except ValueError:
-            logging.warn("Skipping image: %s", url)
+ZIP_COMPRESSION_LEVEL = 6  # zlib level used for text parts (0 - store everything uncompressed)
+ZIP_STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".ttf", ".otf", ".woff")  # already compressed, deflating only wastes CPU
+ZIP_DEFLATE_THREADS = min(4, multiprocessing.cpu_count())
+ZIP_PARALLEL_MIN_BYTES = 64 * 1024  # smaller parts are not worth sending to another thread
+ZIP_PARALLEL_MAX_BYTES = 4 * 1024 * 1024  # streamed parts larger than this are deflated inline, not collected in memory
+ZIP_PARALLEL_PENDING = 4  # parts waiting for the thread pool per thread, more wait for the oldest one to be written
+
+def deflateData(data, level):
+    """
+    Compress data the way zip files expect it (raw deflate stream, no zlib header).
+    RETURNS:
+        tuple - (CRC of uncompressed data, compressed data)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (zlib.crc32(data) & 0xffffffff, compressor.compress(data) + compressor.flush())
+
+
+class ZipPackage(object):
+    """
+    EPUB parts written straight into the .epub file, no temporary files involved.
+    Entries are streamed chunk by chunk, so the whole part never has to be kept in memory.
+    Text parts are deflated, media that is already compressed (and the mimetype file, as the EPUB spec requires) is stored.
+    Larger text parts (chapters, see ZIP_PARALLEL_MIN_BYTES and ZIP_PARALLEL_MAX_BYTES) are deflated by a pool of threads
+    (zlib releases the GIL) and appended a few entries later, in the order they were written.
+    """
+    def __init__(self, path, compressionLevel=ZIP_COMPRESSION_LEVEL, threads=ZIP_DEFLATE_THREADS, timestamp=None):
+        """
+        ARGS:
+            timestamp (datetime.datetime) - modification time of all entries (current time if not provided)
+        """
+        self.path = path
+        self.compressionLevel = compressionLevel
+        self.threads = threads
+        self.dateTime = timestamp.timetuple()[:6] if timestamp else None
+        self._zip = zipfile.ZipFile(path, "w")
+        self._pool = None
+        self._pendingEntries = []  # [(name, data size, AsyncResult), ...]
+
+    def shouldCompress(self, name):
+        if not self.compressionLevel or name == "mimetype":
+            return False
+        return os.path.splitext(name)[1].lower() not in ZIP_STORED_EXTENSIONS
+
+    def writeFile(self, name, data):
+        if self.threads > 1 and len(data) >= ZIP_PARALLEL_MIN_BYTES and self.shouldCompress(name):
+            self._deflateInPool(name, data)
+        else:
+            self.writeChunks(name, [data])
+
+    def writeChunks(self, name, chunks):
+        compress = self.shouldCompress(name)
+        if compress and self.threads > 1:
+            # collect parts of moderate size to deflate them in the thread pool, stream the bigger ones
+            chunks = iter(chunks)
+            collected = []
+            collectedSize = 0
+            for chunk in chunks:
+                collected.append(chunk)
+                collectedSize += len(chunk)
+                if collectedSize > ZIP_PARALLEL_MAX_BYTES:
+                    break
+            else:
+                if collectedSize >= ZIP_PARALLEL_MIN_BYTES:
+                    self._deflateInPool(name, "".join(collected))
+                    return
+            chunks = itertools.chain(collected, chunks)
+        zinfo = self._startEntry(name, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+        compressor = zlib.compressobj(self.compressionLevel, zlib.DEFLATED, -zlib.MAX_WBITS) if compress else None
+        fp = self._zip.fp
+        for chunk in chunks:
+            zinfo.CRC = zlib.crc32(chunk, zinfo.CRC) & 0xffffffff
+            zinfo.file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            zinfo.compress_size += len(chunk)
+            fp.write(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            zinfo.compress_size += len(chunk)
+            fp.write(chunk)
+        self._finishEntry(zinfo)
+
+    def checkpoint(self):
+        """
+        RETURNS:
+            object - state of the package to go back to with rollback()
+        """
+        while self._pendingEntries:
+            self._writePendingEntry()  # entries from before the checkpoint must not end up after it
+        return (self._zip.fp.tell(), len(self._zip.filelist))
+
+    def rollback(self, checkpoint):
+        """
+        Remove entries written since the checkpoint was taken (including an entry written only partially)
+        by cutting them off the end of the file.
+        """
+        offset, entryCount = checkpoint
+        for zinfo in self._zip.filelist[entryCount:]:
+            del self._zip.NameToInfo[zinfo.filename]
+        del self._zip.filelist[entryCount:]
+        self._pendingEntries = []
+        self._zip.fp.seek(offset)
+        self._zip.fp.truncate()
+
+    def _deflateInPool(self, name, data):
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        self._pendingEntries.append((name, len(data), self._pool.apply_async(deflateData, (data, self.compressionLevel))))
+        # the number of waiting entries (not their completion) decides when they are written, so that the order
+        # of entries is always the same
+        while len(self._pendingEntries) > self.threads * ZIP_PARALLEL_PENDING:
+            self._writePendingEntry()
+
+    def _writePendingEntry(self):
+        name, size, result = self._pendingEntries.pop(0)
+        crc, compressedData = result.get()
+        zinfo = self._startEntry(name, zipfile.ZIP_DEFLATED)
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = len(compressedData)
+        self._zip.fp.write(compressedData)
+        self._finishEntry(zinfo)
+
+    def _startEntry(self, name, compressType):
+        if not self._zip.filelist and name != "mimetype":
+            raise ValueError("mimetype has to be the first entry in EPUB file")
+        # zipfile in Python 2 can only write entries of known size, so the local header is written first
+        # and rewritten (with CRC and sizes) once all data is in - the same thing ZipFile.write() does for files
+        zinfo = zipfile.ZipInfo(name, self.dateTime or time.localtime(time.time())[:6])
+        zinfo.external_attr = 0600 << 16
+        zinfo.compress_type = compressType
+        zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+        zinfo.header_offset = self._zip.fp.tell()
+        self._zip._writecheck(zinfo)
+        self._zip._didModify = True
+        self._zip.fp.write(zinfo.FileHeader(False))
+        return zinfo
+
+    def _finishEntry(self, zinfo):
+        if zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("%s is too large" % zinfo.filename)
+        fp = self._zip.fp
+        endOffset = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader(False))
+        fp.seek(endOffset)
+        self._zip.filelist.append(zinfo)
+        self._zip.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self):
+        try:
+            while self._pendingEntries:
+                self._writePendingEntry()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+            self._zip.close()
+
+
+def readChunks(fileObject, chunkSize=64 * 1024):
+    """
+    Iterate over file contents without reading it all into memory.
+    """
+    return iter(lambda: fileObject.read(chunkSize), "")
+
+
+def initializePackageStructure(package):
+    package.writeFile("mimetype", "application/epub+zip")
+    package.writeFile("META-INF/container.xml", CONTAINER_XML.encode("utf-8"))
+
+
+def generateTocNcx(package, documentData, chapters=None):
+    """
+    ARGS:
+        chapters (list[tuple]) - (file name, label) of each content file (see generateContent)
+    """
+    navPoints = []
+    for idx, (fileName, label) in enumerate(chapters or [("content.xhtml", "Content")]):
+        navPoints.append(NAV_POINT_TEMPLATE % {"playOrder": idx + 1, "label": cgi.escape(label), "fileName": fileName})
+    templateValues = dict(documentData.templateValues, navPoints=u"\n".join(navPoints))
+    package.writeFile("OEBPS/toc.ncx", (TOC_NCX_TEMPLATE % templateValues).encode("utf-8"))
+
+
+def generateContentOpf(package, documentData, imageMediaTypes=None, chapters=None):
+    """
+    ARGS:
+        imageMediaTypes (dict) - local image name -> media type (see writeImages)
+        chapters (list[tuple]) - (file name, label) of each content file (see generateContent)
+    """
+    imageMediaTypes = imageMediaTypes or {}
+    imageManifestItems = []
+    for idx, (localName, url) in enumerate(documentData.images):
+        mediaType = imageMediaTypes.get(localName) or detectImageMediaType("", localName)
+        imageManifestItems.append(u'\t\t<item id="img-%d" href=%s media-type="%s"/>' % (idx, quoteattr("img/%s" % localName), mediaType))
+    chapters = chapters or [("content.xhtml", "Content")]
+    contentManifestItems = []
+    spineItems = []
+    for fileName, label in chapters:
+        itemId = os.path.splitext(fileName)[0]
+        contentManifestItems.append(u'\t\t<item id="%s" href="text/%s" media-type="application/xhtml+xml"/>' % (itemId, fileName))
+        spineItems.append(u'\t\t<itemref idref="%s" linear="yes"/>' % itemId)
+    templateValues = dict(documentData.templateValues, imageManifestItems=u"\n".join(imageManifestItems),
+                          contentManifestItems=u"\n".join(contentManifestItems), spineItems=u"\n".join(spineItems),
+                          startFileName=chapters[0][0])
+    package.writeFile("OEBPS/content.opf", (CONTENT_OPF_TEMPLATE % templateValues).encode("utf-8"))
+
+
+def generateContent(package, documentData, contentBlocks=None, maxChapterBytes=CHAPTER_MAX_BYTES, baseName="content"):
+    """
+    Write content of the document, split into multiple files (chapters) at headlines or when it gets too big.
+    ARGS:
+        contentBlocks (iterable[ContentBlock]) - content streamed into the files (e.g. documentData.iterContentBlocks()),
+                                                 documentData.paragraphs are used if not given
+        maxChapterBytes (int) - see CHAPTER_MAX_BYTES
+        baseName (str) - names of the files, unique for each document in the book
+    RETURNS:
+        list[tuple] - (file name, label) of each written file: content.xhtml, content_2.xhtml, ...
+    """
+    if contentBlocks is None:
+        contentBlocks = documentData.paragraphs
+    contentBlocks = iter(contentBlocks)
+    nextBlock = [next(contentBlocks, None)]  # first block of the next chapter
+    chapters = []
+
+    def startsChapter(block, chapterBytes, blockBytes):
+        if not chapterBytes or not maxChapterBytes:
+            return False
+        if getattr(block, "tagName", None) in CHAPTER_HEADING_TAGS and chapterBytes >= CHAPTER_MIN_BYTES:
+            return True
+        return chapterBytes + blockBytes > maxChapterBytes
+
+    def chapterChunks(template):
+        templateHead, templateTail = template.split("%(documentBody)s")
+        yield (templateHead % documentData.templateValues).encode("utf-8")
+        chapterBytes = 0
+        block = nextBlock[0]
+        while block is not None:
+            data = block.encode("utf-8")
+            if startsChapter(block, chapterBytes, len(data)):
+                break
+            yield data if not chapterBytes else "\n" + data
+            chapterBytes += len(data) + 1
+            block = next(contentBlocks, None)
+        nextBlock[0] = block
+        yield (templateTail % documentData.templateValues).encode("utf-8")
+
+    while not chapters or nextBlock[0] is not None:
+        fileName = "%s.xhtml" % baseName if not chapters else "%s_%d.xhtml" % (baseName, len(chapters) + 1)
+        block = nextBlock[0]
+        if not chapters:
+            label = "Content"  # first file starts with the document header
+        elif getattr(block, "tagName", None) in CHAPTER_HEADING_TAGS and block.text:
+            label = block.text
+        else:
+            label = "Content (%d)" % (len(chapters) + 1)
+        package.writeChunks("OEBPS/text/%s" % fileName, chapterChunks(CONTENT_TEMPLATE if not chapters else CHAPTER_TEMPLATE))
+        chapters.append((fileName, label))
+    if len(chapters) > 1:
+        logging.info("Content split into %d files", len(chapters))
+    return chapters
+
+
+def generateCSS(package, documentData, extraCSS=None):
+    if extraCSS is None:
+        extraCSS = []
+    content = "\n".join(extraCSS)
+    package.writeFile("OEBPS/text/content.css", content.encode("utf-8"))
+
+
+IMAGE_DOWNLOAD_WORKERS = 8  # number of images downloaded concurrently
+IMAGE_TIMEOUT = 20  # seconds - max. time to download a single image
+IMAGE_MAX_BYTES = 2 * 1024 * 1024  # larger images are skipped
+IMAGE_BUDGET_BYTES = 10 * 1024 * 1024  # max. total size of images in a single book
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_SPOOL_BYTES = 512 * 1024  # downloaded images larger than this are kept in temporary files instead of memory
+IMAGE_STORE_ENABLED = True  # keep downloaded images on disk between conversions (see ImageStore)
+IMAGE_STORE_MAX_BYTES = 500 * 1024 * 1024  # least recently used images are evicted from the image store above this size
+IMAGE_STORE_MAX_AGE = 7 * 24 * 3600  # seconds - stored images older than this are revalidated with the server
+
+class ImageSkipped(Exception):
+    pass
+
+
+class ByteBudget(object):
+    """
+    Thread-safe counter of bytes that can still be used (e.g. by images in a book).
+    """
+    def __init__(self, limit):
+        self.limit = limit  # None - unlimited
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        RETURNS:
+            bool - False if there is not enough bytes left (nothing is reserved then)
+        """
+        with self._lock:
+            if self.limit is not None and self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+
+class CacheStats(object):
+    """
+    Hit/miss counters of a cache, safe to update from many threads.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def snapshot(self):
+        """
+        RETURNS:
+            tuple - (hits, misses)
+        """
+        with self._lock:
+            return self.hits, self.misses
+
+
+class ImageStore(object):
+    """
+    Downloaded images kept on disk between conversions, so the same logos, photos and diagrams are not downloaded
+    again for every article. Image data is stored once per content (objects/<sha1 of data>), no matter how many
+    URLs point at it, URLs are mapped to the data by urls/<sha1 of url>.json files (with ETag/Last-Modified
+    used to revalidate images older than maxAge). Modification time of the data file is the time of last use,
+    least recently used images are evicted when the store grows over the size limit.
+    Can be passed to worker processes (pickled without its lock).
+    """
+    def __init__(self, storeDir=None, maxBytes=IMAGE_STORE_MAX_BYTES, maxAge=IMAGE_STORE_MAX_AGE, offline=False):
+        """
+        ARGS:
+            storeDir (str) - REPUB_HOME/images if not provided
+            maxBytes (int) - size limit (None - unlimited)
+            maxAge (int) - seconds after which images are revalidated (None - never)
+            offline (bool) - use only stored images, never go to the network
+        """
+        self.storeDir = storeDir or os.path.join(REPUB_HOME, "images")
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.offline = offline
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._totalBytes = None  # computed when needed for the first time, directories are created with the first image
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _urlPath(self, url):
+        key = hashlib.sha1(url.encode("utf-8") if isinstance(url, unicode) else url).hexdigest()
+        return os.path.join(self.storeDir, "urls", key[:2], key + ".json")
+
+    def _objectPath(self, digest):
+        return os.path.join(self.storeDir, "objects", digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        RETURNS:
+            dict or None - metadata of the stored image: url, sha1, size, storedAt, etag, lastModified
+        """
+        try:
+            with open(self._urlPath(url), "rb") as metadataFile:
+                metadata = json.load(metadataFile)
+        except (IOError, ValueError):
+            return None
+        if metadata.get("url") != url or not os.path.exists(self._objectPath(metadata["sha1"])):
+            return None
+        return metadata
+
+    def isFresh(self, metadata):
+        return self.maxAge is None or time.time() - metadata["storedAt"] < self.maxAge
+
+    def open(self, metadata):
+        """
+        RETURNS:
+            file - stored image data
+        RAISES:
+            IOError - if the image has been evicted in the meantime
+        """
+        objectPath = self._objectPath(metadata["sha1"])
+        imgFile = open(objectPath, "rb")
+        try:
+            os.utime(objectPath, None)
+        except OSError:
+            pass
+        return imgFile
+
+    def refresh(self, metadata):
+        """
+        Mark stored image as fresh again (after the server confirmed it has not changed).
+        """
+        self._writeMetadata(dict(metadata, storedAt=time.time()))
+
+    def store(self, url, imgFile, headers=None):
+        """
+        ARGS:
+            imgFile (file) - image data, read from the current position to the end (position is restored)
+            headers (mimetools.Message) - response headers
+        RETURNS:
+            dict - metadata of the stored image
+        """
+        position = imgFile.tell()
+        digest = hashlib.sha1()
+        size = 0
+        if not os.path.isdir(self.storeDir):
+            try:
+                os.makedirs(self.storeDir)
+            except OSError:
+                pass  # created by another thread/process in the meantime
+        tmpFile = tempfile.NamedTemporaryFile(dir=self.storeDir, delete=False)
+        try:
+            for chunk in readChunks(imgFile, IMAGE_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                tmpFile.write(chunk)
+            tmpFile.close()
+            objectPath = self._objectPath(digest.hexdigest())
+            with self._lock:
+                if os.path.exists(objectPath):
+                    os.remove(tmpFile.name)  # same image stored before (maybe under another URL)
+                else:
+                    if not os.path.isdir(os.path.dirname(objectPath)):
+                        try:
+                            os.makedirs(os.path.dirname(objectPath))
+                        except OSError:
+                            pass  # created by another process in the meantime
+                    os.rename(tmpFile.name, objectPath)
+                    if self._totalBytes is not None:
+                        self._totalBytes += size
+        except:
+            tmpFile.close()
+            if os.path.exists(tmpFile.name):
+                os.remove(tmpFile.name)
+            raise
+        finally:
+            imgFile.seek(position)
+        metadata = {"url": url, "sha1": digest.hexdigest(), "size": size, "storedAt": time.time(),
+                    "etag": headers.getheader("ETag") if headers else None,
+                    "lastModified": headers.getheader("Last-Modified") if headers else None}
+        self._writeMetadata(metadata)
+        with self._lock:
+            self._evict()
+        return metadata
+
+    def _writeMetadata(self, metadata):
+        urlPath = self._urlPath(metadata["url"])
+        if not os.path.isdir(os.path.dirname(urlPath)):
+            try:
+                os.makedirs(os.path.dirname(urlPath))
+            except OSError:
+                pass  # created by another thread/process in the meantime
+        tmpPath = "%s.%d.%d.tmp" % (urlPath, os.getpid(), threading.current_thread().ident)
+        with open(tmpPath, "wb") as fileOut:
+            json.dump(metadata, fileOut)
+        os.rename(tmpPath, urlPath)
+
+    def _evict(self):
+        if self.maxBytes is None:
+            return
+        objectsDir = os.path.join(self.storeDir, "objects")
+        if self._totalBytes is None:
+            self._totalBytes = sum(os.path.getsize(os.path.join(dirPath, fileName))
+                                   for dirPath, dirNames, fileNames in os.walk(objectsDir) for fileName in fileNames)
+        if self._totalBytes <= self.maxBytes:
+            return
+        objects = []
+        for dirPath, dirNames, fileNames in os.walk(objectsDir):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                try:
+                    objects.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except OSError:
+                    pass
+        objects.sort()
+        self._totalBytes = sum(size for lastUse, size, path in objects)
+        evictedCount = 0
+        for lastUse, size, path in objects:
+            if self._totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)  # URLs pointing at it are dropped by lookup
+            except OSError:
+                pass
+            self._totalBytes -= size
+            evictedCount += 1
+        logging.debug("Evicted %d images from image store", evictedCount)
+
+
+def openStoredImage(imageStore, storedImage, budget, maxBytes=IMAGE_MAX_BYTES):
+    """
+    RETURNS:
+        file - image data from the image store, None if it has been evicted in the meantime
+    RAISES:
+        ImageSkipped - if the image does not fit in the size limits
+    """
+    if maxBytes is not None and storedImage["size"] > maxBytes:
+        raise ImageSkipped("image too large (%d bytes)" % storedImage["size"])
+    try:
+        imgFile = imageStore.open(storedImage)
+    except IOError:
+        return None
+    if not budget.reserve(storedImage["size"]):
+        imgFile.close()
+        raise ImageSkipped("image budget exceeded")
+    logging.info("Using stored image: %s", storedImage["url"])
+    return imgFile
+
+
+def downloadImage(fetchEngine, url, budget, maxBytes=IMAGE_MAX_BYTES, imageStore=None, archive=None):
+    """
+    Download a single image, streaming it in chunks to a spooled temporary file.
+    Size limits are checked against Content-Length before the download starts and then again while downloading
+    (Content-Length is not always sent, nor always true).
+    With an image store, images stored before are used instead (the ones older than its maxAge are revalidated
+    first) and downloaded images are added to it. Images found in the archive are not downloaded at all.
+    ARGS:
+        budget (ByteBudget) - bytes left for images in the book
+        maxBytes (int) - size limit for this image (None - unlimited)
+        imageStore (ImageStore)
+        archive (WARCArchive or MHTMLArchive) - archive the document comes from
+    RETURNS:
+        file - image data (rewound), None if the image could not be downloaded
+    """
+    imgFile = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_BYTES)
+    imgSize = 0
+    reserved = 0
+    try:
+        archivedImage = archive.find(url) if archive is not None else None
+        if archivedImage is not None:
+            data = archive.read(archivedImage)
+            if maxBytes is not None and len(data) > maxBytes:
+                raise ImageSkipped("image too large (%d bytes)" % len(data))
+            if not budget.reserve(len(data)):
+                raise ImageSkipped("image budget exceeded")
+            imgFile.write(data)
+            imgFile.seek(0)
+            return imgFile
+        storedImage = imageStore.lookup(url) if imageStore else None
+        requestHeaders = {}
+        if storedImage is not None:
+            if imageStore.offline or imageStore.isFresh(storedImage):
+                storedFile = openStoredImage(imageStore, storedImage, budget, maxBytes)
+                if storedFile is not None:
+                    imageStore.stats.hit()
+                    imgFile.close()
+                    return storedFile
+            if storedImage["etag"]:
+                requestHeaders["If-None-Match"] = storedImage["etag"]
+            if storedImage["lastModified"]:
+                requestHeaders["If-Modified-Since"] = storedImage["lastModified"]
+        if imageStore and imageStore.offline:
+            raise ImageSkipped("not in image store (offline mode)")
+        logging.info("Downloading image: %s", url)
+        deadline = time.time() + IMAGE_TIMEOUT
+        response = fetchEngine.open(url, headers=requestHeaders, timeout=IMAGE_TIMEOUT, deadline=deadline)
+        if response.status == 304 and storedImage is not None:
+            response.read()
+            imageStore.refresh(storedImage)
+            storedFile = openStoredImage(imageStore, storedImage, budget, maxBytes)
+            if storedFile is not None:
+                imageStore.stats.hit()
+                imgFile.close()
+                return storedFile
+            raise urllib2.URLError("image evicted from image store")
+        if imageStore:
+            imageStore.stats.miss()
+        try:
+            contentLength = response.headers.getheader("Content-Length", "")
+            if contentLength.isdigit():
+                if maxBytes is not None and int(contentLength) > maxBytes:
+                    raise ImageSkipped("image too large (%s bytes)" % contentLength)
+                if not budget.reserve(int(contentLength)):
+                    raise ImageSkipped("image budget exceeded")
+                reserved = int(contentLength)
+            while True:
+                if time.time() > deadline:
+                    raise urllib2.URLError("timed out after %ss" % IMAGE_TIMEOUT)
+                chunk = response.read(IMAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                imgSize += len(chunk)
+                if maxBytes is not None and imgSize > maxBytes:
+                    raise ImageSkipped("image too large (more than %d bytes)" % maxBytes)
+                if imgSize > reserved:
+                    if not budget.reserve(imgSize - reserved):
+                        raise ImageSkipped("image budget exceeded")
+                    reserved = imgSize
+                imgFile.write(chunk)
+        finally:
+            response.close()
+        if reserved > imgSize:
+            budget.release(reserved - imgSize)
+        imgFile.seek(0)
+        if imageStore:
+            try:
+                imageStore.store(url, imgFile, response.headers)
+            except (IOError, OSError), ex:
+                logging.warn("Could not add image to image store: %s", ex)
+        return imgFile
+    except ImageSkipped, ex:
+        logging.warn("Skipping image %s: %s", url, ex)
+    except (urllib2.URLError, socket.error, httplib.HTTPException), ex:
+        logging.error("Failed to download image %s: %s", url, ex)
+    except ValueError:
+        logging.warn("Skipping image: %s", url)
+    budget.release(reserved)
+    imgFile.close()
+    return None
+
+
+def downloadImages(documentData, fetchEngine=None, workers=IMAGE_DOWNLOAD_WORKERS,
+                   maxBytes=IMAGE_MAX_BYTES, budgetBytes=IMAGE_BUDGET_BYTES, budget=None, imageStore=None,
+                   archive=None):
+    """
+    Download all images referenced by the document using a bounded pool of threads,
+    so that total time is close to the time needed for the slowest image.
+    Images that could not be downloaded (or did not fit in the size limits) are removed from the document.
+    ARGS:
+        maxBytes (int) - size limit for a single image (None - unlimited)
+        budgetBytes (int) - size limit for all images in the book (None - unlimited)
+        budget (ByteBudget) - budget shared with other documents in the book, replaces budgetBytes
+        imageStore (ImageStore) - images stored by previous conversions (see downloadImage)
+        archive (WARCArchive or MHTMLArchive) - images are taken from the archive when possible
+    RETURNS:
+        dict - local image name -> file with image data (to be closed by the caller)
+    """
+    if not documentData.images:
+        return {}
+    fetchEngine = fetchEngine or defaultFetchEngine(perHostConnections=workers, timeout=IMAGE_TIMEOUT)
+    budget = budget or ByteBudget(budgetBytes)
+    usedBefore = budget.used
+    pool = ThreadPool(min(workers, len(documentData.images)))
+    try:
+        results = pool.map(lambda (localName, url): downloadImage(fetchEngine, url, budget, maxBytes, imageStore,
+                                                                  archive),
+                           documentData.images)
+    finally:
+        pool.close()
+        pool.join()
+    imageFiles = dict((localName, imgFile) for (localName, url), imgFile in zip(documentData.images, results) if imgFile)
+    documentData.removeImages([localName for localName, url in documentData.images if localName not in imageFiles])
+    logging.info("Downloaded %d images (%d bytes)", len(imageFiles), budget.used - usedBefore)
+    return imageFiles
+
+
+IMAGE_MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+    ".webp": "image/webp",
+    ".bmp": "image/bmp",
+}
+
+def detectImageMediaType(header, localName):
+    """
+    Check the actual image format - file extensions taken from URLs are often missing or wrong.
+    ARGS:
+        header (str) - first bytes of the image
+        localName (str) - image file name, its extension is used if the format is not recognized
+    RETURNS:
+        str - media type to be used in the manifest
+    """
+    if header.startswith("\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith("\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:6] in ("GIF87a", "GIF89a"):
+        return "image/gif"
+    if header[:4] == "RIFF" and header[8:12] == "WEBP":
+        return "image/webp"
+    if header[:2] == "BM":
+        return "image/bmp"
+    if "<svg" in header:
+        return "image/svg+xml"
+    return IMAGE_MEDIA_TYPES.get(os.path.splitext(localName)[1].lower(), "application/octet-stream")
+
+
+def optimizeImageWorker(job):
+    """
+    Downscale, convert to grayscale and recompress a single image (executed in a worker process).
+    Photos are saved as JPEG, everything else (diagrams, logos, ...) as PNG with a small palette.
+    ARGS:
+        job (tuple) - (localName, imgData, resolution, jpegQuality, pngColors)
+    RETURNS:
+        tuple - (localName, new local name, new image data or None if the original should be kept, error message or None)
+    """
+    localName, imgData, resolution, jpegQuality, pngColors = job
+    try:
+        img = Image.open(StringIO.StringIO(imgData))
+        isPhoto = img.format in ("JPEG", "WEBP")
+        img.thumbnail(resolution, Image.ANTIALIAS)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # transparent areas would turn black, put the image on white background instead
+            img = img.convert("RGBA")
+            background = Image.new("RGBA", img.size, (255, 255, 255, 255))
+            img = Image.alpha_composite(background, img)
+        img = img.convert("L")
+
+        newLocalName = os.path.splitext(localName)[0] + (".jpg" if isPhoto else ".png")
+        newData = StringIO.StringIO()
+        if isPhoto:
+            img.save(newData, "JPEG", quality=jpegQuality, optimize=True)
+        else:
+            img = img.convert("RGB").convert("P", palette=Image.ADAPTIVE, colors=pngColors)
+            img.save(newData, "PNG", optimize=True, bits=4 if pngColors <= 16 else 8)
+        newData = newData.getvalue()
+        if newLocalName == localName and len(newData) >= len(imgData):
+            return (localName, localName, None, None)
+        return (localName, newLocalName, newData, None)
+    except Exception, ex:
+        return (localName, localName, None, "%s: %s" % (ex.__class__.__name__, ex))
+
+
+def optimizeImages(documentData, imageFiles, resolution=DEVICE_RESOLUTION, jpegQuality=IMAGE_JPEG_QUALITY,
+                   pngColors=IMAGE_PNG_COLORS, workers=None):
+    """
+    Make downloaded images smaller and faster to render on e-ink readers (see optimizeImageWorker).
+    Images are processed by a pool of worker processes, image format changes are reflected in the document.
+    ARGS:
+        imageFiles (dict) - local image name -> file with image data (see downloadImages)
+        resolution (tuple) - (width, height) of the device screen
+        jpegQuality (int) - 1-95
+        pngColors (int) - number of shades of gray in PNG images
+        workers (int) - number of worker processes (number of CPUs if not provided)
+    RETURNS:
+        dict - local image name -> file with image data, replaces imageFiles (which should be closed by the caller),
+               imageFiles itself if there was nothing to optimize
+    """
+    if Image is None:
+        logging.warn("PIL (Pillow) is not installed - images will not be optimized")
+        return imageFiles
+    if not imageFiles:
+        return imageFiles
+    jobs = []
+    for localName, imgFile in sorted(imageFiles.items()):
+        imgFile.seek(0)
+        jobs.append((localName, imgFile.read(), resolution, jpegQuality, pngColors))
+    sizeBefore = sum(len(job[1]) for job in jobs)
+    if len(jobs) == 1 or multiprocessing.current_process().daemon:
+        results = map(optimizeImageWorker, jobs)  # daemonic processes (e.g. batch mode workers) cannot have children
+    else:
+        pool = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(), len(jobs)))
+        try:
+            results = pool.map(optimizeImageWorker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    optimizedFiles = {}
+    newNames = {}
+    for (localName, newLocalName, newData, error), job in zip(results, jobs):
+        if error:
+            logging.warn("Failed to optimize image %s: %s", localName, error)
+        optimizedFiles[newLocalName] = StringIO.StringIO(newData if newData is not None else job[1])
+        if newLocalName != localName:
+            newNames[localName] = newLocalName
+    documentData.renameImages(newNames)
+    logging.info("Optimized images: %d -> %d bytes", sizeBefore, sum(len(imgFile.getvalue()) for imgFile in optimizedFiles.values()))
+    return optimizedFiles
+
+
+def writeImages(package, documentData, imageFiles):
+    """
+    Copy downloaded images into the package.
+    ARGS:
+        imageFiles (dict) - local image name -> file with image data
+    RETURNS:
+        dict - local image name -> media type
+    """
+    mediaTypes = {}
+    for localName, url in documentData.images:
+        imgFile = imageFiles[localName]
+        imgFile.seek(0)
+        mediaTypes[localName] = detectImageMediaType(imgFile.read(256), localName)
+        imgFile.seek(0)
+        package.writeChunks("OEBPS/img/%s" % localName, readChunks(imgFile, IMAGE_CHUNK_SIZE))
+    return mediaTypes
+
+
+def saveAsEPUB(tmpDir, outputDir, outputFilename, compressionLevel=ZIP_COMPRESSION_LEVEL, timestamp=None):
+    """
+    Zip a package written to a directory by DirectoryPackage.
+    """
+    out = ZipPackage(os.path.join(outputDir, outputFilename), compressionLevel, timestamp=timestamp)
+    try:
+        out.writeFile("mimetype", "application/epub+zip")
+        for root, dirs, files in os.walk(tmpDir):
+            dirs.sort()
+            for filename in sorted(files):
+                name = os.path.relpath(os.path.join(root, filename), tmpDir).replace(os.sep, "/")
+                if name != "mimetype":
+                    with open(os.path.join(root, filename), "rb") as fileIn:
+                        out.writeChunks(name, readChunks(fileIn))
+    finally:
+        out.close()
+
+
+FETCH_WORKERS = 8  # number of concurrent downloads when fetching lists of URLs
+FETCH_PER_HOST_CONNECTIONS = 2  # be polite - never have more requests than this in flight to a single host
+FETCH_PER_HOST_DELAY = 0.0  # minimum number of seconds between two requests to the same host
+FETCH_TIMEOUT = 30  # seconds
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 1.0  # seconds to wait before the first retry, doubled after every failed attempt
+FETCH_MAX_REDIRECTS = 5
+FETCH_RETRY_STATUS = (429, 500, 502, 503, 504)
+FETCH_USER_AGENT = "Python-urllib/%s" % sys.version[:3]
+HTTP_CACHE_ENABLED = True  # keep downloaded pages on disk, revalidate them instead of downloading again
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024  # least recently used pages are evicted above this size
+RESULT_CACHE_MAX_BYTES = 200 * 1024 * 1024  # least recently used books are evicted from the result cache above this size
+BOILERPLATE_FILTER = False  # drop paragraphs found in many earlier documents from the same site (footers, newsletter pitches)
+BOILERPLATE_MIN_DOCUMENTS = 3  # ... i.e. in at least this many different documents
+BOILERPLATE_MIN_TEXT = 40  # shorter paragraphs, headings, list items and <pre> blocks are never dropped
+BOILERPLATE_MAX_BLOCKS = 10000  # max. number of paragraph fingerprints remembered per site
+BOILERPLATE_MAX_DOCUMENTS = 1000  # max. number of documents remembered per site (converting one again does not count)
+
+
+def isURL(location):
+    return bool(re.match(r"https?://", location, re.I))
+
+
+def decodeContent(data, contentEncoding):
+    """
+    Inflate response body according to Content-Encoding header.
+    """
+    if contentEncoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if contentEncoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            return zlib.decompress(data, -zlib.MAX_WBITS)  # raw deflate stream sent by some servers
+    return data
+
+
+class _CookieResponse(object):
+    """
+    Minimal response object expected by cookielib.CookieJar.extract_cookies.
+    """
+    def __init__(self, headers):
+        self._headers = headers
+
+    def info(self):
+        return self._headers
+
+
+class FetchResponse(object):
+    """
+    Response to a request made by FetchEngine. The connection goes back to the pool (and the per-host slot is
+    freed) as soon as the body has been read completely or the response is closed.
+    """
+    def __init__(self, engine, url, poolKey, connection, response, hostSlot):
+        self.url = url  # final URL (after redirects)
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        self.body = None  # filled in by FetchEngine.fetch()
+        self._engine = engine
+        self._poolKey = poolKey
+        self._connection = connection
+        self._response = response
+        self._hostSlot = hostSlot
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt) if amt else self._response.read()
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            raise
+        if not amt or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self._connection is None:
+            return
+        reusable = self._response.isclosed() and not self._response.will_close
+        if not reusable:
+            self._response.close()
+        self._engine._releaseConnection(self._poolKey, self._connection, reusable)
+        self._connection = None
+        self._hostSlot.release()
+
+
+class CachedResponse(object):
+    """
+    Response served from HTTPCache, with the body (already decoded) available as .body like in FetchResponse.
+    """
+    def __init__(self, metadata, body):
+        self.url = metadata["finalUrl"]
+        self.status = 200
+        self.reason = "OK"
+        self.headers = httplib.HTTPMessage(StringIO.StringIO(metadata["headers"].encode("latin-1")))
+        self.body = body
+        self.storedAt = metadata["storedAt"]
+
+    def read(self, amt=None):
+        return self.body
+
+    def close(self):
+        pass
+
+
+class DiskCache(object):
+    """
+    Base class of on-disk caches. Each entry is a pair of files: <hash of key>.json with metadata
+    and <hash of key><BODY_SUFFIX> with the data. Modification time of the .json file is the time of last use,
+    least recently used entries are evicted when the cache grows over the size limit.
+    Safe to use from many threads of one process, can be passed to worker processes (pickled without its lock).
+    """
+    BODY_SUFFIX = ".body"
+
+    def __init__(self, cacheDir, maxBytes=None):
+        """
+        ARGS:
+            cacheDir (str)
+            maxBytes (int) - size limit (None - unlimited)
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._totalBytes = None  # computed when needed for the first time
+        # the directory is created with the first entry - runs which never store anything leave no trace
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _entryPaths(self, key):
+        digest = hashlib.sha1(key.encode("utf-8") if isinstance(key, unicode) else key).hexdigest()
+        basePath = os.path.join(self.cacheDir, digest[:2], digest)
+        return basePath + ".json", basePath + self.BODY_SUFFIX
+
+    def _readMetadata(self, key):
+        """
+        RETURNS:
+            dict or None - metadata of the entry (marked as used) with "key" equal to the given one
+        """
+        metadataPath, bodyPath = self._entryPaths(key)
+        try:
+            with open(metadataPath, "rb") as metadataFile:
+                metadata = json.load(metadataFile)
+            os.utime(metadataPath, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if metadata.get("key") != key or not os.path.exists(bodyPath):
+            return None
+        return metadata
+
+    def _storeEntry(self, key, metadata, chunks):
+        """
+        ARGS:
+            metadata (dict) - stored with "key" added
+            chunks (iterable[str]) - data
+        """
+        metadataPath, bodyPath = self._entryPaths(key)
+        metadata = dict(metadata, key=key)
+        with self._lock:
+            oldSize = self._entrySize(metadataPath, bodyPath)
+            if not os.path.isdir(os.path.dirname(metadataPath)):
+                try:
+                    os.makedirs(os.path.dirname(metadataPath))
+                except OSError:
+                    pass  # created by another process in the meantime
+            # write to temporary files first, so that readers never see partially written entries
+            with open(bodyPath + ".tmp", "wb") as fileOut:
+                for chunk in chunks:
+                    fileOut.write(chunk)
+            os.rename(bodyPath + ".tmp", bodyPath)
+            with open(metadataPath + ".tmp", "wb") as fileOut:
+                json.dump(metadata, fileOut)
+            os.rename(metadataPath + ".tmp", metadataPath)
+            if self._totalBytes is not None:
+                self._totalBytes += self._entrySize(metadataPath, bodyPath) - oldSize
+            self._evict()
+
+    def _entrySize(self, metadataPath, bodyPath):
+        size = 0
+        for path in (metadataPath, bodyPath):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _scan(self):
+        """
+        RETURNS:
+            list[tuple] - (time of last use, size, metadata path, body path) for all entries
+        """
+        entries = []
+        for dirPath, dirNames, fileNames in os.walk(self.cacheDir):
+            for fileName in fileNames:
+                if fileName.endswith(".json"):
+                    metadataPath = os.path.join(dirPath, fileName)
+                    bodyPath = metadataPath[:-len(".json")] + self.BODY_SUFFIX
+                    try:
+                        lastUse = os.path.getmtime(metadataPath)
+                    except OSError:
+                        continue
+                    entries.append((lastUse, self._entrySize(metadataPath, bodyPath), metadataPath, bodyPath))
+        return entries
+
+    def _evict(self):
+        if self.maxBytes is None:
+            return
+        if self._totalBytes is None:
+            self._totalBytes = sum(entry[1] for entry in self._scan())
+        if self._totalBytes <= self.maxBytes:
+            return
+        entries = sorted(self._scan())
+        self._totalBytes = sum(entry[1] for entry in entries)
+        evictedCount = 0
+        for lastUse, size, metadataPath, bodyPath in entries:
+            if self._totalBytes <= self.maxBytes:
+                break
+            for path in (metadataPath, bodyPath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._totalBytes -= size
+            evictedCount += 1
+        logging.debug("Evicted %d entries from %s", evictedCount, self.cacheDir)
+
+
+class HTTPCache(DiskCache):
+    """
+    Downloaded documents kept on disk, keyed by URL. Metadata holds response headers (used for revalidation
+    with ETag/Last-Modified), the body is stored decoded.
+    """
+    def __init__(self, cacheDir=None, maxBytes=HTTP_CACHE_MAX_BYTES, offline=False):
+        """
+        ARGS:
+            cacheDir (str) - REPUB_HOME/http if not provided
+            maxBytes (int) - size limit (None - unlimited)
+            offline (bool) - never go to the network, documents missing in the cache cannot be fetched
+        """
+        DiskCache.__init__(self, cacheDir or os.path.join(REPUB_HOME, "http"), maxBytes)
+        self.offline = offline
+
+    def lookup(self, url):
+        """
+        RETURNS:
+            CachedResponse or None
+        """
+        metadata = self._readMetadata(url)
+        if metadata is None:
+            return None
+        try:
+            with open(self._entryPaths(url)[1], "rb") as bodyFile:
+                return CachedResponse(metadata, bodyFile.read())
+        except IOError:
+            return None
+
+    def store(self, url, response, body):
+        """
+        Save downloaded document, unless the server does not allow it (Cache-Control: no-store).
+        ARGS:
+            response (FetchResponse)
+            body (str) - decoded body
+        """
+        if "no-store" in (response.headers.getheader("Cache-Control") or "").lower():
+            return
+        # body is stored decoded, headers describing the transfer do not apply to it any more
+        headers = "".join(header for header in response.headers.headers
+                          if header.split(":", 1)[0].strip().lower() not in ("content-encoding", "content-length",
+                                                                             "transfer-encoding", "set-cookie"))
+        metadata = {"finalUrl": response.url, "storedAt": time.time(), "headers": headers.decode("latin-1")}
+        self._storeEntry(url, metadata, [body])
+
+
+class ResultCache(DiskCache):
+    """
+    Books converted before, keyed by everything that affects the output (see conversionKey), so that converting
+    an unchanged document again only copies the book. Best used together with deterministic mode.
+    """
+    BODY_SUFFIX = ".epub"
+
+    def __init__(self, cacheDir=None, maxBytes=RESULT_CACHE_MAX_BYTES):
+        """
+        ARGS:
+            cacheDir (str) - REPUB_HOME/results if not provided
+            maxBytes (int) - size limit (None - unlimited)
+        """
+        DiskCache.__init__(self, cacheDir or os.path.join(REPUB_HOME, "results"), maxBytes)
+
+    def copyTo(self, key, outDir, outputFilename=None):
+        """
+        Copy the cached book to the output directory.
+        ARGS:
+            outputFilename (str) - name of the output file (the name used when the book was stored if not provided)
+        RETURNS:
+            str - path to the output file, None if the book is not in the cache
+        """
+        metadata = self._readMetadata(key)
+        if metadata is None:
+            self.stats.miss()
+            return None
+        self.stats.hit()
+        outputPath = os.path.join(outDir, outputFilename or metadata["outputFilename"].encode("utf-8"))
+        try:
+            with open(self._entryPaths(key)[1], "rb") as fileIn:
+                with open(outputPath, "wb") as fileOut:
+                    for chunk in readChunks(fileIn):
+                        fileOut.write(chunk)
+        except IOError, ex:
+            logging.warn("Could not copy cached book: %s", ex)
+            return None
+        return outputPath
+
+    def store(self, key, outputPath):
+        with open(outputPath, "rb") as fileIn:
+            self._storeEntry(key, {"outputFilename": os.path.basename(outputPath).decode("utf-8", "replace"),
+                                   "storedAt": time.time()}, readChunks(fileIn))
+
+
+BOILERPLATE_NORMALIZE_REGEXP = re.compile(r"\W+", re.U)
+
+def blockFingerprint(text):
+    """
+    RETURNS:
+        str - short hash of paragraph text ignoring case, punctuation and whitespace, None for empty text
+    """
+    normalized = BOILERPLATE_NORMALIZE_REGEXP.sub(u" ", text.lower()).strip()
+    if not normalized:
+        return None
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+class BoilerplateIndex(object):
+    """
+    Fingerprints of paragraphs seen in documents converted before, one <host>.json file per site with the number
+    of documents each fingerprint was seen in. Paragraphs found in many documents from the same site are
+    boilerplate. Files are read once per process, the index of each site is capped at maxBlocks fingerprints
+    (most recently seen and confirmed boilerplate are kept).
+    Can be passed to worker processes (pickled without its lock and loaded sites), updates are serialized
+    with a lock file per site.
+    """
+    def __init__(self, indexDir=None, minDocuments=BOILERPLATE_MIN_DOCUMENTS, maxBlocks=BOILERPLATE_MAX_BLOCKS,
+                 maxDocuments=BOILERPLATE_MAX_DOCUMENTS):
+        """
+        ARGS:
+            indexDir (str) - REPUB_HOME/boilerplate if not provided
+            minDocuments (int) - see BOILERPLATE_MIN_DOCUMENTS
+            maxBlocks (int) - see BOILERPLATE_MAX_BLOCKS
+            maxDocuments (int) - see BOILERPLATE_MAX_DOCUMENTS
+        """
+        self.indexDir = indexDir or os.path.join(REPUB_HOME, "boilerplate")
+        self.minDocuments = minDocuments
+        self.maxBlocks = maxBlocks
+        self.maxDocuments = maxDocuments
+        self._lock = threading.Lock()
+        self._knownBlocks = {}  # host -> frozenset of boilerplate fingerprints
+        if not os.path.isdir(self.indexDir):
+            os.makedirs(self.indexDir)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        state["_knownBlocks"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _sitePath(self, host):
+        return os.path.join(self.indexDir, host + ".json")
+
+    def _readSite(self, host):
+        """
+        RETURNS:
+            dict - {"documents": [document key], "blocks": {fingerprint: [document count, last seen]}, "seen": int}
+        """
+        try:
+            with open(self._sitePath(host), "rb") as siteFile:
+                site = json.load(siteFile)
+            if isinstance(site.get("documents"), list) and isinstance(site.get("blocks"), dict):
+                return site
+            logging.warn("Ignoring invalid boilerplate index: %s", self._sitePath(host))
+        except IOError:
+            pass
+        except ValueError, ex:
+            logging.warn("Ignoring invalid boilerplate index %s: %s", self._sitePath(host), ex)
+        return {"documents": [], "blocks": {}, "seen": 0}
+
+    def _boilerplate(self, site):
+        return frozenset(fingerprint for fingerprint, (count, _) in site["blocks"].iteritems()
+                         if count >= self.minDocuments)
+
+    def knownBlocks(self, host):
+        """
+        RETURNS:
+            frozenset - fingerprints (see blockFingerprint) of boilerplate paragraphs of the site
+        """
+        with self._lock:
+            knownBlocks = self._knownBlocks.get(host)
+            if knownBlocks is None:
+                knownBlocks = self._knownBlocks[host] = self._boilerplate(self._readSite(host))
+        return knownBlocks
+
+    def digest(self, host):
+        """
+        RETURNS:
+            str - hash of the boilerplate fingerprints of the site, changes whenever the set of dropped paragraphs does
+        """
+        knownBlocks = self.knownBlocks(host) if host else frozenset()
+        return hashlib.sha1(",".join(sorted(knownBlocks))).hexdigest()
+
+    def record(self, host, documentKey, fingerprints):
+        """
+        Add paragraphs of a converted document to the index of its site. A document recorded before
+        is not counted again.
+        ARGS:
+            documentKey (str) - identifies the document, e.g. hash of its URL
+            fingerprints (set[str]) - fingerprints of all paragraphs of the document
+        """
+        with self._lock:
+            lockFile = open(self._sitePath(host) + ".lock", "ab")
+            try:
+                if fcntl:
+                    fcntl.flock(lockFile, fcntl.LOCK_EX)  # other processes wait until the file is replaced
+                self._recordLocked(host, documentKey, fingerprints)
+            finally:
+                lockFile.close()  # releases the lock
+
+    def _recordLocked(self, host, documentKey, fingerprints):
+        site = self._readSite(host)  # merge with documents recorded by other processes in the meantime
+        if documentKey not in site["documents"]:
+            site["documents"] = (site["documents"] + [documentKey])[-self.maxDocuments:]
+            site["seen"] = seen = site.get("seen", 0) + 1
+            blocks = site["blocks"]
+            for fingerprint in fingerprints:
+                count = blocks.get(fingerprint, (0, 0))[0]
+                blocks[fingerprint] = [count + 1, seen]
+            if len(blocks) > self.maxBlocks:
+                # keep confirmed boilerplate and the most recently seen paragraphs, with some room to grow
+                kept = sorted(blocks.iteritems(), key=lambda (_, (count, lastSeen)): (count >= self.minDocuments, lastSeen),
+                              reverse=True)[:self.maxBlocks * 3 / 4]
+                site["blocks"] = dict(kept)
+            sitePath = self._sitePath(host)
+            tmpPath = "%s.%d.%d.tmp" % (sitePath, os.getpid(), threading.current_thread().ident)
+            with open(tmpPath, "wb") as fileOut:
+                json.dump(site, fileOut, separators=(",", ":"))
+            os.rename(tmpPath, sitePath)
+        self._knownBlocks[host] = self._boilerplate(site)
+
+
+class FetchEngine(object):
+    """
+    Downloads web pages (concurrently when given a list of URLs).
+    - keep-alive connections are pooled and reused per host
+    - number of requests in flight and request rate are limited per host
+    - failed requests (network errors, 5xx, 429) are retried with exponential backoff
+    - one cookie jar is shared by all requests
+    - documents are cached on disk and revalidated with conditional requests (if given HTTPCache)
+    Python 2 has no asyncio, so concurrency comes from a pool of threads - good enough as the work is waiting on the network.
+    """
+    def __init__(self, workers=FETCH_WORKERS, perHostConnections=FETCH_PER_HOST_CONNECTIONS,
+                 perHostDelay=FETCH_PER_HOST_DELAY, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES,
+                 backoff=FETCH_BACKOFF, cookieJar=None, cache=None):
+        self.workers = max(1, workers)
+        self.perHostConnections = max(1, perHostConnections)
+        self.perHostDelay = perHostDelay
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cookieJar = cookieJar if cookieJar is not None else cookielib.CookieJar()
+        self.cache = cache  # HTTPCache used by fetch()
+        self._lock = threading.Lock()
+        self._idleConnections = {}  # (scheme, host, port) -> [connection, ...]
+        self._hostSlots = {}  # host -> semaphore
+        self._nextRequestTime = {}  # host -> earliest time the next request can be started
+
+    def _getHostSlot(self, host):
+        with self._lock:
+            if host not in self._hostSlots:
+                self._hostSlots[host] = threading.BoundedSemaphore(self.perHostConnections)
+            return self._hostSlots[host]
+
+    def _waitForHostTurn(self, host):
+        if not self.perHostDelay:
+            return
+        with self._lock:
+            now = time.time()
+            startTime = max(now, self._nextRequestTime.get(host, 0))
+            self._nextRequestTime[host] = startTime + self.perHostDelay
+        if startTime > now:
+            time.sleep(startTime - now)
+
+    def _acquireConnection(self, poolKey, timeout):
+        """
+        RETURNS:
+            tuple - (connection, True if it is a reused keep-alive connection)
+        """
+        with self._lock:
+            idleConnections = self._idleConnections.get(poolKey)
+            connection = idleConnections.pop() if idleConnections else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        scheme, host, port = poolKey
+        connectionClass = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        return connectionClass(host, port, timeout=timeout), False
+
+    def _releaseConnection(self, poolKey, connection, reusable):
+        if reusable:
+            with self._lock:
+                idleConnections = self._idleConnections.setdefault(poolKey, [])
+                if len(idleConnections) < self.perHostConnections:
+                    idleConnections.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idleConnections = self._idleConnections
+            self._idleConnections = {}
+        for connections in idleConnections.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, headers, timeout):
+        parsedUrl = urlparse(url)
+        if parsedUrl.scheme not in ("http", "https") or not parsedUrl.hostname:
+            raise ValueError("unsupported URL: %s" % url)
+        poolKey = (parsedUrl.scheme, parsedUrl.hostname, parsedUrl.port)
+        path = parsedUrl.path or "/"
+        if parsedUrl.params:
+            path += ";" + parsedUrl.params
+        if parsedUrl.query:
+            path += "?" + parsedUrl.query
+
+        request = urllib2.Request(url, headers=headers)
+        self.cookieJar.add_cookie_header(request)
+        requestHeaders = dict(request.header_items())
+
+        hostSlot = self._getHostSlot(parsedUrl.netloc)
+        hostSlot.acquire()
+        try:
+            self._waitForHostTurn(parsedUrl.netloc)
+            while True:
+                connection, reused = self._acquireConnection(poolKey, timeout)
+                try:
+                    connection.request("GET", path, headers=requestHeaders)
+                    response = connection.getresponse()
+                    break
+                except (socket.error, httplib.HTTPException):
+                    connection.close()
+                    if not reused:
+                        raise
+                    # keep-alive connection closed by the server in the meantime, try a fresh one
+            self.cookieJar.extract_cookies(_CookieResponse(response.msg), request)
+            return FetchResponse(self, url, poolKey, connection, response, hostSlot)
+        except:
+            hostSlot.release()
+            raise
+
+    def _requestWithRetries(self, url, headers, timeout, deadline=None):
+        outOfTime = lambda delay: deadline is not None and time.time() + delay >= deadline
+        attempt = 0
+        while True:
+            delay = self.backoff * (2 ** attempt)
+            requestTimeout = timeout
+            if deadline is not None:
+                if outOfTime(0):
+                    raise urllib2.URLError("timed out: %s" % url)
+                requestTimeout = min(timeout, deadline - time.time())
+            try:
+                response = self._request(url, headers, requestTimeout)
+                if response.status not in FETCH_RETRY_STATUS or attempt >= self.retries:
+                    return response
+                retryAfter = response.headers.getheader("Retry-After")
+                if retryAfter and retryAfter.isdigit():
+                    delay = max(delay, int(retryAfter))
+                if outOfTime(delay):
+                    return response  # no time left for another attempt
+                logging.warn("HTTP %d from %s, retrying in %.1fs", response.status, url, delay)
+                response.read()
+            except (socket.error, httplib.HTTPException), ex:
+                # unknown host names do not get resolved by waiting
+                if attempt >= self.retries or isinstance(ex, socket.gaierror) or outOfTime(delay):
+                    raise urllib2.URLError(ex)
+                logging.warn("Request to %s failed (%s), retrying in %.1fs", url, ex, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def open(self, url, headers=None, timeout=None, deadline=None):
+        """
+        Send GET request, following redirects.
+        ARGS:
+            url (str)
+            headers (dict) - additional request headers
+            timeout (float) - socket timeout in seconds (engine default if not provided)
+            deadline (float) - time (as returned by time.time()) after which no more attempts are made,
+                               socket timeouts are shortened to end by then
+        RETURNS:
+            FetchResponse - the body has not been read yet, read() or close() it to release the connection
+        RAISES:
+            urllib2.HTTPError - for 4xx/5xx responses
+            urllib2.URLError - when the server could not be reached
+        """
+        requestHeaders = {"User-Agent": FETCH_USER_AGENT}
+        requestHeaders.update(headers or {})
+        timeout = timeout or self.timeout
+        for _ in range(FETCH_MAX_REDIRECTS + 1):
+            response = self._requestWithRetries(url, requestHeaders, timeout, deadline)
+            location = response.headers.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.read()
+                raise urllib2.HTTPError(url, response.status, response.reason, response.headers, None)
+            return response
+        raise urllib2.URLError("too many redirects: %s" % url)
+
+    def fetch(self, url, headers=None, timeout=None, deadline=None):
+        """
+        Download the whole document. With a cache, a document downloaded before is revalidated
+        (and not downloaded again if the server says it has not changed).
+        ARGS:
+            deadline (float) - see open()
+        RETURNS:
+            FetchResponse or CachedResponse - with the (decoded) body available as .body
+        """
+        requestHeaders = {"Accept-Encoding": "gzip, deflate"}
+        requestHeaders.update(headers or {})
+        cachedResponse = self.cache.lookup(url) if self.cache else None
+        if self.cache and self.cache.offline:
+            if cachedResponse is None:
+                raise urllib2.URLError("not in cache (offline mode): %s" % url)
+            self.cache.stats.hit()
+            return cachedResponse
+        if cachedResponse is not None:
+            if cachedResponse.headers.getheader("ETag"):
+                requestHeaders["If-None-Match"] = cachedResponse.headers.getheader("ETag")
+            if cachedResponse.headers.getheader("Last-Modified"):
+                requestHeaders["If-Modified-Since"] = cachedResponse.headers.getheader("Last-Modified")
+        response = self.open(url, requestHeaders, timeout, deadline)
+        if response.status == 304 and cachedResponse is not None:
+            response.read()
+            logging.debug("Not modified, using cached copy: %s", url)
+            self.cache.stats.hit()
+            return cachedResponse
+        response.body = decodeContent(response.read(), response.headers.getheader("Content-Encoding"))
+        if self.cache:
+            self.cache.stats.miss()
+            if response.status == 200:
+                self.cache.store(url, response, response.body)
+        return response
+
+    def fetchAll(self, urls):
+        """
+        Download many documents concurrently. Results are yielded as soon as each download completes
+        (i.e. not in input order), so they can be processed while other downloads are still in flight.
+        YIELDS:
+            tuple - (url, body or None, error message or None)
+        """
+        urls = list(urls)
+        pendingUrls = Queue.Queue()
+        for url in urls:
+            pendingUrls.put(url)
+        results = Queue.Queue()
+        stopped = threading.Event()  # set when the caller stops iterating - remaining URLs are not downloaded
+
+        def worker():
+            while not stopped.is_set():
+                try:
+                    url = pendingUrls.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results.put((url, self.fetch(url).body, None))
+                except Exception, ex:
+                    logging.debug(traceback.format_exc())
+                    results.put((url, None, "%s: %s" % (ex.__class__.__name__, ex)))
+
+        threads = []
+        for _ in range(min(self.workers, len(urls))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        interrupted = False
+        try:
+            for _ in urls:
+                while True:
+                    try:
+                        yield results.get(True, 1)  # timeout keeps the main thread responsive to Ctrl+C
+                        break
+                    except Queue.Empty:
+                        pass
+        except KeyboardInterrupt:
+            interrupted = True
+            raise
+        finally:
+            stopped.set()
+            if not interrupted:
+                for thread in threads:
+                    thread.join()  # downloads in flight end within the fetch timeout
+
+
+_defaultFetchEngines = {}  # (pid, settings) -> FetchEngine
+
+def defaultFetchEngine(**settings):
+    """
+    Fetch engine shared by all downloads made by this process with the same settings
+    (connections are never shared with forked worker processes).
+    ARGS:
+        settings - passed to FetchEngine constructor
+    """
+    key = (os.getpid(), tuple(sorted(settings.items())))
+    if key not in _defaultFetchEngines:
+        _defaultFetchEngines[key] = FetchEngine(**settings)
+    return _defaultFetchEngines[key]
+
+
+ARCHIVE_CONTENT_TYPE = "text/html"  # archive records converted by default (content type prefix, "" - all)
+ARCHIVE_HEADER_BYTES = 64 * 1024  # max. size of WARC record and HTTP headers
+
+
+class ArchiveRecord(object):
+    """
+    Location of a document stored in an archive.
+    """
+    __slots__ = ("url", "contentType", "offset", "length", "memberOffset", "transferEncoding", "contentEncoding")
+
+    def __init__(self, url, contentType, offset, length, memberOffset=None, transferEncoding=None,
+                 contentEncoding=None):
+        self.url = url
+        self.contentType = contentType  # lowercase, without parameters
+        self.offset = offset  # payload offset in the file (or in the decompressed record of a .warc.gz)
+        self.length = length
+        self.memberOffset = memberOffset  # offset of the gzip member with the record, None if not compressed
+        self.transferEncoding = transferEncoding  # "chunked" if the payload was stored with chunked encoding
+        self.contentEncoding = contentEncoding
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def parseHeaderBlock(headerBlock):
+    """
+    RETURNS:
+        tuple - (first line, {lowercase header name: value})
+    """
+    lines = headerBlock.split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    return lines[0].strip(), headers
 
-def saveAsEPUB(tmpDir, outputDir, outputFilename):
-    out = zipfile.ZipFile(os.path.join(outputDir, outputFilename), "w")
-    for root, dirs, files in os.walk(tmpDir):
-        for filename in files:
-            out.write(os.path.join(root, filename), os.path.join(os.path.relpath(root, tmpDir), filename))
-    out.close()
+
+def decodeChunked(data):
+    """
+    RETURNS:
+        str - body sent with Transfer-Encoding: chunked
+    """
+    chunks = []
+    position = 0
+    while True:
+        lineEnd = data.find("\r\n", position)
+        if lineEnd < 0:
+            break
+        try:
+            chunkSize = int(data[position:lineEnd].split(";")[0].strip(), 16)
+        except ValueError:
+            break
+        if not chunkSize:
+            break
+        chunks.append(data[lineEnd + 2:lineEnd + 2 + chunkSize])
+        position = lineEnd + 2 + chunkSize + 2
+    return "".join(chunks)
+
+
+class WARCArchive(object):
+    """
+    Web archive (.warc or .warc.gz) read through a memory map. Opening the archive builds an index of response
+    and resource records (URL -> payload offset and length) by reading only record headers, so selected
+    documents and images are read straight from the map without loading the whole archive.
+    In a .warc.gz each record is a separate gzip member, only the records read are decompressed
+    (the index is built in one decompressing pass with constant memory).
+    Can be passed to worker processes (pickled with its index, the file is mapped again when needed).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = []  # ArchiveRecord, in archive order
+        self._recordsByUrl = {}
+        self._map = None
+        self._lock = threading.Lock()
+        with open(self.path, "rb") as archiveFile:
+            self.compressed = archiveFile.read(2) == "\x1f\x8b"
+        if self.compressed:
+            self._indexCompressed()
+        else:
+            self._indexPlain()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        state["_map"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _getMap(self):
+        with self._lock:
+            if self._map is None:
+                with open(self.path, "rb") as archiveFile:
+                    if not os.fstat(archiveFile.fileno()).st_size:
+                        return ""
+                    self._map = mmap.mmap(archiveFile.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+    def _addRecord(self, data, recordOffset, memberOffset=None):
+        """
+        Index the record starting at data[recordOffset:].
+        RETURNS:
+            int - offset of the end of the record block in data, None if data does not contain a valid record
+        """
+        headerEnd = data.find("\r\n\r\n", recordOffset, recordOffset + ARCHIVE_HEADER_BYTES)
+        if headerEnd < 0 or not data[recordOffset:recordOffset + 5] == "WARC/":
+            return None
+        _, headers = parseHeaderBlock(data[recordOffset:headerEnd])
+        try:
+            blockLength = int(headers.get("content-length", ""))
+        except ValueError:
+            return None
+        blockOffset = headerEnd + 4
+        recordType = headers.get("warc-type")
+        url = headers.get("warc-target-uri", "").strip("<>")
+        if url and recordType == "response":
+            httpHeaderEnd = data.find("\r\n\r\n", blockOffset, min(blockOffset + blockLength, blockOffset + ARCHIVE_HEADER_BYTES))
+            if httpHeaderEnd >= 0:
+                statusLine, httpHeaders = parseHeaderBlock(data[blockOffset:httpHeaderEnd])
+                statusParts = statusLine.split()
+                if len(statusParts) > 1 and statusParts[1] == "200":
+                    payloadOffset = httpHeaderEnd + 4
+                    self._appendRecord(ArchiveRecord(
+                        url, httpHeaders.get("content-type", "").split(";")[0].strip().lower(), payloadOffset,
+                        blockOffset + blockLength - payloadOffset, memberOffset,
+                        httpHeaders.get("transfer-encoding", "").lower() or None,
+                        httpHeaders.get("content-encoding", "").lower() or None))
+        elif url and recordType == "resource":
+            self._appendRecord(ArchiveRecord(url, headers.get("content-type", "").split(";")[0].strip().lower(),
+                                             blockOffset, blockLength, memberOffset))
+        return blockOffset + blockLength
+
+    def _appendRecord(self, record):
+        if record.url not in self._recordsByUrl:  # the first capture of a URL wins
+            self._recordsByUrl[record.url] = record
+            self.records.append(record)
+
+    def _indexPlain(self):
+        data = self._getMap()
+        offset = 0
+        while offset < len(data):
+            blockEnd = self._addRecord(data, offset)
+            if blockEnd is None:
+                if data[offset:].strip():
+                    logging.warn("Invalid WARC record at offset %d in %s, rest of the archive skipped", offset, self.path)
+                break
+            offset = blockEnd
+            while data[offset:offset + 2] == "\r\n":
+                offset += 2
+
+    def _indexCompressed(self):
+        data = self._getMap()
+        memberOffset = 0
+        while memberOffset < len(data):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            head = ""  # first ARCHIVE_HEADER_BYTES of the decompressed record, the rest is discarded
+            position = memberOffset
+            nextMember = None
+            try:
+                while position < len(data):
+                    chunk = data[position:position + 64 * 1024]
+                    position += len(chunk)
+                    output = decompressor.decompress(chunk)
+                    if len(head) < ARCHIVE_HEADER_BYTES:
+                        head += output[:ARCHIVE_HEADER_BYTES - len(head)]
+                    if decompressor.unused_data:
+                        nextMember = position - len(decompressor.unused_data)
+                        break
+            except zlib.error, ex:
+                logging.warn("Invalid gzip data at offset %d in %s, rest of the archive skipped: %s",
+                             memberOffset, self.path, ex)
+                break
+            if self._addRecord(head, 0, memberOffset) is None and head.strip():
+                logging.warn("Invalid WARC record at offset %d in %s", memberOffset, self.path)
+            memberOffset = nextMember if nextMember is not None else len(data)
+
+    def find(self, url):
+        """
+        RETURNS:
+            ArchiveRecord - None if the URL is not in the archive
+        """
+        return self._recordsByUrl.get(url) or self._recordsByUrl.get(url.split("#")[0])
+
+    def read(self, record):
+        """
+        RETURNS:
+            str - (decoded) payload of the record
+        """
+        data = self._getMap()
+        if record.memberOffset is None:
+            payload = data[record.offset:record.offset + record.length]
+        else:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output = []
+            outputLength = 0
+            position = record.memberOffset
+            end = record.offset + record.length
+            while outputLength < end and position < len(data) and not decompressor.unused_data:
+                output.append(decompressor.decompress(data[position:position + 64 * 1024]))
+                outputLength += len(output[-1])
+                position += 64 * 1024
+            payload = "".join(output)[record.offset:end]
+        if record.transferEncoding == "chunked":
+            payload = decodeChunked(payload)
+        return decodeContent(payload, record.contentEncoding)
 
 
+class MHTMLArchive(object):
+    """
+    Web page saved as MHTML (.mht, .mhtml). Parts are decoded when the archive is opened - MHTML files
+    hold a single page, so they are small.
+    Can be passed to worker processes (pickled as the path, parsed again when needed).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._parts = None  # url -> (ArchiveRecord, payload)
+        self.records = [record for record, _ in self._loadParts()]
+
+    def __getstate__(self):
+        return {"path": self.path, "records": self.records, "_parts": None}
+
+    def _loadParts(self):
+        if self._parts is None:
+            with open(self.path, "rb") as archiveFile:
+                message = email.message_from_file(archiveFile)
+            parts = collections.OrderedDict()
+            for part in message.walk():
+                url = (part.get("Content-Location") or "").strip()
+                if part.is_multipart() or not url or url in parts:
+                    continue
+                payload = part.get_payload(decode=True) or ""
+                parts[url] = (ArchiveRecord(url, part.get_content_type().lower(), 0, len(payload)), payload)
+            self._parts = parts
+        return self._parts.values()
+
+    def find(self, url):
+        self._loadParts()
+        part = self._parts.get(url) or self._parts.get(url.split("#")[0])
+        return part[0] if part else None
+
+    def read(self, record):
+        self._loadParts()
+        return self._parts[record.url][1]
+
+    def close(self):
+        pass
+
+
+def openArchive(path):
+    """
+    RETURNS:
+        WARCArchive or MHTMLArchive - depending on the contents of the file
+    RAISES:
+        ValueError - if the file is neither
+    """
+    with open(path, "rb") as archiveFile:
+        head = archiveFile.read(4096)
+    if head.startswith("WARC/") or head.startswith("\x1f\x8b"):
+        return WARCArchive(path)
+    if re.search(r"^content-type:\s*multipart/related", head, re.I | re.M):
+        return MHTMLArchive(path)
+    raise ValueError("not a WARC or MHTML file: %s" % path)
+
+
+def selectArchiveRecords(archive, urlPattern=None, contentType=ARCHIVE_CONTENT_TYPE):
+    """
+    ARGS:
+        urlPattern (str) - regular expression the URL has to match (anywhere), None - all URLs
+        contentType (str) - content type prefix, e.g. "text/html" ("" or None - all)
+    RETURNS:
+        list[ArchiveRecord] - in archive order
+    """
+    urlRegexp = re.compile(urlPattern) if urlPattern else None
+    return [record for record in archive.records
+            if (not contentType or record.contentType.startswith(contentType.lower())) and
+               (urlRegexp is None or urlRegexp.search(record.url))]
+
 
-def downloadWebPageSource(url):
+def downloadWebPageSource(url, fetchEngine=None):
     """
     Download HTML given an URL to web page.
     """
     try:
-        cj = cookielib.CookieJar()
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
-        urllib2.install_opener(opener)
-        response = urllib2.urlopen(url)
-        #~ print response.info()
-        contentEncoding = response.info().getheader('Content-Encoding')
-        if contentEncoding == 'gzip':
-            logging.warn('Content-Encoding is gzip - inflating')
-            import zlib
-            return zlib.decompress(response.read(), 16 + zlib.MAX_WBITS)
-        return response.read()
+        return (fetchEngine or defaultFetchEngine()).fetch(url).body
     except urllib2.HTTPError as e:
         logging.error("Failed to open source URL (%d): %s", e.code, 
                           BaseHTTPServer.BaseHTTPRequestHandler.responses.get(e.code, "Unknown error"))
         raise
 
 
-def generateEPUB(url, sourceDocument, outDir, includeDIV=False, includeIMG=False, includeTables=False, extraCSS=None, debug=False):
+def extractDocument(documentData, sourceDocument, includeDIV=False, includeIMG=False, includeTables=False):
+    """
+    Load the document for writing it into a package.
+    RETURNS:
+        iterator[ContentBlock] - content to be streamed into the package, None if it has been extracted
+                                 into documentData.paragraphs (list of images is needed up front)
+    """
+    if includeIMG:
+        # list of images is needed up front, to download them and put them in the manifest
+        documentData.parseDocument(sourceDocument, includeDIV=includeDIV, includeIMG=includeIMG, includeTables=includeTables)
+        return None
+    # stream the text straight into the package
+    documentData.loadDocument(sourceDocument, includeDIV=includeDIV, includeIMG=includeIMG, includeTables=includeTables)
+    return documentData.iterContentBlocks()
+
+
+def writeDocumentContent(package, documentData, contentBlocks=None, imageMaxBytes=IMAGE_MAX_BYTES, imageBudget=None,
+                         optimizeIMG=False, deviceResolution=DEVICE_RESOLUTION, jpegQuality=IMAGE_JPEG_QUALITY,
+                         maxChapterBytes=CHAPTER_MAX_BYTES, baseName="content", imageStore=None, archive=None):
+    """
+    Download images of a document loaded by extractDocument and write them together with the content into the package.
+    ARGS:
+        contentBlocks (iterator[ContentBlock]) - see extractDocument
+        imageBudget (ByteBudget) - bytes left for images in the book (None - unlimited)
+        imageStore (ImageStore) - see downloadImage
+        archive (WARCArchive or MHTMLArchive) - see downloadImage
+        baseName (str) - see generateContent
+    RETURNS:
+        tuple - (list of chapters - see generateContent, dict of image media types - see writeImages)
+    """
+    imageFiles = {}
+    try:
+        imageFiles = downloadImages(documentData, maxBytes=imageMaxBytes, budget=imageBudget or ByteBudget(None),
+                                    imageStore=imageStore, archive=archive)
+        if optimizeIMG:
+            optimizedFiles = optimizeImages(documentData, imageFiles, resolution=deviceResolution, jpegQuality=jpegQuality)
+            if optimizedFiles is not imageFiles:  # the same files are returned when there is nothing to optimize
+                for imgFile in imageFiles.values():
+                    imgFile.close()
+                imageFiles = optimizedFiles
+        imageMediaTypes = writeImages(package, documentData, imageFiles)
+    finally:
+        for imgFile in imageFiles.values():
+            imgFile.close()
+    chapters = generateContent(package, documentData, contentBlocks, maxChapterBytes=maxChapterBytes, baseName=baseName)
+    return chapters, imageMediaTypes
+
+
+def defaultOutputFilename(documentData):
+    """
+    RETURNS:
+        str - output file name made of document title and conversion date
+    """
+    allowedChars = ['_', '-', '!', ' ']
+    sanitizedTitle = filter(lambda ch: ch.isalpha() or ch.isdigit() or ch in allowedChars, documentData.title)
+    outputFilename = "%s_%s.epub" % (sanitizedTitle, documentData.fileDateString)
+    return string.translate(outputFilename.encode("utf-8"), None, "?*:\\/|")
+
+
+def openPackage(outDir, outputFilename, documentData, debug=False, compressionLevel=ZIP_COMPRESSION_LEVEL):
+    """
+    RETURNS:
+        tuple - (package, directory with package files in debug mode or None)
+    """
+    if debug:
+        # keep all files in debug mode, zip them at the end
+        # unique name - batch workers may start conversions in the same second
+        tmpDir = tempfile.mkdtemp(prefix=datetime.datetime.now().strftime("%Y.%m.%d_%H.%M.%S_"), dir=outDir)
+        logging.debug("Using temp directory: %s", tmpDir)
+        return DirectoryPackage(tmpDir), tmpDir
+    return ZipPackage(os.path.join(outDir, outputFilename), compressionLevel,
+                      timestamp=documentData.conversionTimestamp if documentData.deterministic else None), None
+
+
+def conversionKey(sourceDocument, url, options, boilerplateIndex=None):
+    """
+    ARGS:
+        boilerplateIndex (BoilerplateIndex) - paragraphs dropped as boilerplate are part of the key
+    RETURNS:
+        str - key identifying the result of converting the document with given options by this version of repub
+    """
+    documentURL = url or findDocumentURL(sourceDocument)
+    siteRules = SITE_RULES.rulesFor(documentURL)
+    boilerplate = boilerplateIndex.digest(siteHost(documentURL)) if boilerplateIndex is not None else None
+    return hashlib.sha1(json.dumps({"source": hashlib.sha1(sourceDocument).hexdigest(), "url": url or "",
+                                    "version": __version__, "options": options, "siteRules": siteRules.digest,
+                                    "boilerplate": boilerplate},
+                                   sort_keys=True)).hexdigest()
+
+
+def generateEPUB(url, sourceDocument, outDir, includeDIV=False, includeIMG=False, includeTables=False, extraCSS=None, debug=False,
+                 outputFilename=None, imageMaxBytes=IMAGE_MAX_BYTES, imageBudgetBytes=IMAGE_BUDGET_BYTES,
+                 optimizeIMG=False, deviceResolution=DEVICE_RESOLUTION, jpegQuality=IMAGE_JPEG_QUALITY,
+                 compressionLevel=ZIP_COMPRESSION_LEVEL, parserBackend=None, maxChapterBytes=CHAPTER_MAX_BYTES,
+                 imageStore=None, deterministic=DETERMINISTIC_BUILD, resultCache=None, boilerplateIndex=None,
+                 archive=None):
     """
     Generate .epub file.
     ARGS:
@@ -566,52 +3336,898 @@ def generateEPUB(url, sourceDocument, outDir, includeDIV=False, includeIMG=False
         includeIMG (bool)
         includeTables (bool)
         extraCSS (list[str]) - additional CSS to include in .epub, e.g. custom fonts
+        outputFilename (str) - name of the output file (derived from document title if not provided)
+        imageMaxBytes (int) - images larger than this are skipped (None - no limit)
+        imageBudgetBytes (int) - max. total size of images in the book (None - no limit)
+        optimizeIMG (bool) - downscale images to deviceResolution, convert to grayscale and recompress
+        deviceResolution (tuple) - (width, height)
+        jpegQuality (int)
+        compressionLevel (int) - zlib compression level for text parts (0-9)
+        parserBackend (str) - see PARSER_BACKEND
+        maxChapterBytes (int) - see CHAPTER_MAX_BYTES
+        imageStore (ImageStore) - images kept between conversions (None - always download them)
+        deterministic (bool) - see DETERMINISTIC_BUILD
+        resultCache (ResultCache) - copy the book converted before from the same source with the same options
+        boilerplateIndex (BoilerplateIndex) - skip paragraphs repeated in many documents from the same site
+        archive (WARCArchive or MHTMLArchive) - archive the document comes from, its images are taken from it
     RETURNS:
         str - path to output file
     """
-    documentData = DocumentData(url)
+    if resultCache and not debug:
+        cacheKey = conversionKey(sourceDocument, url, dict(
+            includeDIV=includeDIV, includeIMG=includeIMG, includeTables=includeTables, extraCSS=extraCSS,
+            imageMaxBytes=imageMaxBytes, imageBudgetBytes=imageBudgetBytes, optimizeIMG=optimizeIMG,
+            deviceResolution=deviceResolution, jpegQuality=jpegQuality, compressionLevel=compressionLevel,
+            parserBackend=parserBackend, maxChapterBytes=maxChapterBytes, deterministic=deterministic,
+            archive=archive.path if archive is not None else None), boilerplateIndex)
+        outputPath = resultCache.copyTo(cacheKey, outDir, outputFilename)
+        if outputPath:
+            logging.info("Document has not changed, using book converted before: %s", outputPath)
+            return outputPath
+
+    documentData = DocumentData(url, parserBackend=parserBackend, deterministic=deterministic,
+                                boilerplateIndex=boilerplateIndex)
+    contentBlocks = extractDocument(documentData, sourceDocument, includeDIV=includeDIV, includeIMG=includeIMG,
+                                    includeTables=includeTables)
+    outputFilename = outputFilename or defaultOutputFilename(documentData)
+    outputPath = os.path.join(outDir, outputFilename)
+    package, tmpDir = openPackage(outDir, outputFilename, documentData, debug, compressionLevel)
+    try:
+        initializePackageStructure(package)
+        chapters, imageMediaTypes = writeDocumentContent(package, documentData, contentBlocks,
+                                                         imageMaxBytes=imageMaxBytes,
+                                                         imageBudget=ByteBudget(imageBudgetBytes),
+                                                         optimizeIMG=optimizeIMG, deviceResolution=deviceResolution,
+                                                         jpegQuality=jpegQuality, maxChapterBytes=maxChapterBytes,
+                                                         imageStore=imageStore, archive=archive)
+        generateTocNcx(package, documentData, chapters)
+        generateContentOpf(package, documentData, imageMediaTypes, chapters)
+        generateCSS(package, documentData, extraCSS)
+        package.close()
+    except:
+        package.close()
+        if not debug and os.path.exists(outputPath):
+            os.remove(outputPath)  # do not leave incomplete files behind
+        raise
+    if debug:
+        saveAsEPUB(tmpDir, outDir, outputFilename, compressionLevel,
+                   timestamp=documentData.conversionTimestamp if documentData.deterministic else None)
+    elif resultCache:
+        try:
+            resultCache.store(cacheKey, outputPath)
+        except (IOError, OSError), ex:
+            logging.warn("Could not add book to result cache: %s", ex)
+    return outputPath
+
+
+def iterBundleSources(inputs, fetchEngine=None, window=None, archive=None):
+    """
+    Read/download bundle inputs in their original order. URLs are downloaded concurrently a window at a time,
+    so only a few documents are kept in memory at once.
+    ARGS:
+        window (int) - number of inputs fetched ahead (twice the number of fetch workers if not provided)
+        archive (WARCArchive or MHTMLArchive) - inputs are URLs of documents in the archive
+    YIELDS:
+        tuple - (inputName, url, sourceDocument or None, error message or None)
+    """
+    if archive is not None:
+        for url in inputs:
+            record = archive.find(url)
+            yield (url, url, archive.read(record), None) if record else (url, url, None, "not in archive")
+        return
+    fetchEngine = fetchEngine or defaultFetchEngine()
+    window = window or 2 * fetchEngine.workers
+    for offset in xrange(0, len(inputs), window):
+        windowInputs = inputs[offset:offset + window]
+        urls = [inputName for inputName in windowInputs if isURL(inputName)]
+        downloads = {}
+        if urls:
+            downloads = dict((url, (body, error)) for url, body, error in fetchEngine.fetchAll(urls))
+        for inputName in windowInputs:
+            if inputName in downloads:
+                body, error = downloads.pop(inputName)
+                yield (inputName, inputName, body, error)
+                continue
+            try:
+                with open(inputName, "rb") as inputFile:
+                    yield (inputName, None, inputFile.read(), None)
+            except IOError, ex:
+                yield (inputName, None, None, "%s: %s" % (ex.__class__.__name__, ex))
+
 
-    tmpDir = ""
+def generateBundleEPUB(inputs, outDir, title, fetchEngine=None, outputFilename=None, includeDIV=False, includeIMG=False,
+                       includeTables=False, extraCSS=None, debug=False, imageMaxBytes=IMAGE_MAX_BYTES,
+                       imageBudgetBytes=IMAGE_BUDGET_BYTES, optimizeIMG=False, deviceResolution=DEVICE_RESOLUTION,
+                       jpegQuality=IMAGE_JPEG_QUALITY, compressionLevel=ZIP_COMPRESSION_LEVEL, parserBackend=None,
+                       maxChapterBytes=CHAPTER_MAX_BYTES, imageStore=None, deterministic=DETERMINISTIC_BUILD,
+                       boilerplateIndex=None, archive=None):
+    """
+    Generate a single .epub file with many documents, one (or more, see generateContent) chapter per document.
+    Documents are converted and appended to the book one at a time. Documents that fail to convert are skipped.
+    ARGS:
+        inputs (list[str]) - input file paths and URLs (URLs of documents in the archive if given), in the order
+                             of chapters
+        outDir (str) - output directory
+        title (str) - title of the book
+        fetchEngine (FetchEngine) - used to download URLs (default settings if not provided)
+        outputFilename (str) - name of the output file (derived from the title if not provided)
+        imageBudgetBytes (int) - max. total size of images in the whole book (None - no limit)
+        other arguments - see generateEPUB
+    RETURNS:
+        tuple - (path to output file, list of inputs included in the book)
+    """
+    bookData = DocumentData(deterministic=deterministic)
+    bookData.title = title
+    bookData.author = "Various"
+    bookData.templateValues = bookData.makeTemplateValues()
+    outputFilename = outputFilename or defaultOutputFilename(bookData)
+    outputPath = os.path.join(outDir, outputFilename)
+    package, tmpDir = openPackage(outDir, outputFilename, bookData, debug, compressionLevel)
+    imageBudget = ByteBudget(imageBudgetBytes)
+    sourcesDigest = hashlib.sha1(title.encode("utf-8"))
+    chapters = []
+    imageMediaTypes = {}
+    includedInputs = []
+    try:
+        initializePackageStructure(package)
+        for idx, (inputName, url, sourceDocument, error) in enumerate(iterBundleSources(inputs, fetchEngine,
+                                                                                        archive=archive)):
+            if not error:
+                sourcesDigest.update(sourceDocument)
+                documentData = DocumentData(url, parserBackend=parserBackend, imagePrefix="a%d_" % (idx + 1),
+                                            deterministic=deterministic, boilerplateIndex=boilerplateIndex)
+                checkpoint = package.checkpoint()
+                try:
+                    contentBlocks = extractDocument(documentData, sourceDocument, includeDIV=includeDIV,
+                                                    includeIMG=includeIMG, includeTables=includeTables)
+                    documentChapters, documentMediaTypes = writeDocumentContent(
+                        package, documentData, contentBlocks, imageMaxBytes=imageMaxBytes, imageBudget=imageBudget,
+                        optimizeIMG=optimizeIMG, deviceResolution=deviceResolution, jpegQuality=jpegQuality,
+                        maxChapterBytes=maxChapterBytes, baseName="article%d" % (idx + 1), imageStore=imageStore,
+                        archive=archive)
+                except Exception, ex:
+                    logging.debug(traceback.format_exc())
+                    error = "%s: %s" % (ex.__class__.__name__, ex)
+                    package.rollback(checkpoint)  # parts of the document written so far are not in the manifest
+            if error:
+                logging.error("[%d/%d] FAILED %s: %s", idx + 1, len(inputs), inputName, error)
+                continue
+            documentChapters[0] = (documentChapters[0][0], documentData.title or inputName)
+            chapters.extend(documentChapters)
+            bookData.images.extend(documentData.images)
+            imageMediaTypes.update(documentMediaTypes)
+            includedInputs.append(inputs[idx])
+            logging.info("[%d/%d] %s -> %s", idx + 1, len(inputs), inputName, documentData.title)
+        if not chapters:
+            raise ValueError("none of the documents could be converted")
+        if deterministic:
+            bookData.uuid = sourceUUID(None, sourcesDigest.hexdigest())
+            bookData.templateValues = bookData.makeTemplateValues()
+        generateTocNcx(package, bookData, chapters)
+        generateContentOpf(package, bookData, imageMediaTypes, chapters)
+        generateCSS(package, bookData, extraCSS)
+        package.close()
+    except:
+        package.close()
+        if not debug and os.path.exists(outputPath):
+            os.remove(outputPath)  # do not leave incomplete files behind
+        raise
     if debug:
-        tmpDir = os.path.join(outDir, documentData.conversionTimestamp.strftime("%Y.%m.%d_%H.%M.%S"))
-        os.mkdir(tmpDir)
+        saveAsEPUB(tmpDir, outDir, outputFilename, compressionLevel,
+                   timestamp=bookData.conversionTimestamp if deterministic else None)
+    logging.info("Bundle finished: %d documents included, %d failed", len(includedInputs),
+                 len(inputs) - len(includedInputs))
+    return outputPath, includedInputs
+
+
+BATCH_INPUT_EXTENSIONS = (".html", ".htm", ".xhtml")
+
+def collectBatchInputs(inputSpec):
+    """
+    Expand batch input specification into a list of input files/URLs.
+    ARGS:
+        inputSpec (str) - directory (all HTML files inside), glob pattern, single HTML file
+                          or manifest file (one path or URL per line, '#' starts a comment)
+    RETURNS:
+        list[str] - input paths and URLs, in stable order so that output names do not change between runs
+    """
+    if os.path.isdir(inputSpec):
+        inputs = [os.path.join(inputSpec, filename) for filename in os.listdir(inputSpec)
+                  if os.path.splitext(filename)[1].lower() in BATCH_INPUT_EXTENSIONS]
+    elif os.path.isfile(inputSpec):
+        if os.path.splitext(inputSpec)[1].lower() in BATCH_INPUT_EXTENSIONS:
+            return [inputSpec]
+        inputs = []
+        manifestDir = os.path.dirname(inputSpec)
+        with open(inputSpec, "rb") as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    inputs.append(line if isURL(line) else os.path.join(manifestDir, line))
+        seen = set()
+        return [entry for entry in inputs if not (entry in seen or seen.add(entry))]  # keep manifest order
     else:
-        tmpDir = tempfile.mkdtemp()
-    logging.debug("Using temp directory: %s", tmpDir)
+        inputs = glob.glob(inputSpec)
+    return sorted(inputs)
+
+
+def batchOutputFilenames(inputs):
+    """
+    Name output files after input files/URLs (not document titles), so that rerunning a batch overwrites
+    the same files instead of producing new ones every day.
+    RETURNS:
+        list[str] - output file name for each input
+    """
+    usedNames = set()
+    outputFilenames = []
+    for inputName in inputs:
+        if isURL(inputName):
+            parsedUrl = urlparse(inputName)
+            path = parsedUrl.path.rstrip("/")
+            if os.path.splitext(path)[1].lower() in BATCH_INPUT_EXTENSIONS:
+                path = os.path.splitext(path)[0]
+            baseName = re.sub(r"[^\w.-]+", "_", "%s%s" % (parsedUrl.netloc, path))[:100]
+        else:
+            baseName = os.path.splitext(os.path.basename(inputName))[0]
+        baseName = baseName or "document"
+        outputFilename = "%s.epub" % baseName
+        suffix = 2
+        while outputFilename.lower() in usedNames:
+            outputFilename = "%s_%d.epub" % (baseName, suffix)
+            suffix += 1
+        usedNames.add(outputFilename.lower())
+        outputFilenames.append(outputFilename)
+    return outputFilenames
+
+
+def iterBatchJobs(inputs, outDir, options, fetchEngine=None):
+    """
+    Generate work items for convertFileWorker. Local files are handed out immediately, URLs are downloaded
+    concurrently and handed out one by one as their downloads complete.
+    YIELDS:
+        tuple - (inputName, url, sourceDocument, error, outDir, outputFilename, options)
+    """
+    outputFilenames = dict(zip(inputs, batchOutputFilenames(inputs)))
+    archive = options.get("archive")
+    if archive is not None:
+        if not options.get("includeIMG"):
+            options = dict(options, archive=None)  # workers need the archive (and its index) only for images
+        for url in inputs:
+            record = archive.find(url)
+            yield (url, url, archive.read(record) if record else None, None if record else "not in archive", outDir,
+                   outputFilenames[url], options)
+        return
+    urls = []
+    for inputName in inputs:
+        if isURL(inputName):
+            urls.append(inputName)
+        else:
+            yield (inputName, None, None, None, outDir, outputFilenames[inputName], options)
+    if urls:
+        for url, sourceDocument, error in (fetchEngine or FetchEngine()).fetchAll(urls):
+            yield (url, url, sourceDocument, error, outDir, outputFilenames[url], options)
+
+
+def convertFileWorker(job):
+    """
+    Convert a single document in a worker process. Exceptions never leave this function so that
+    one broken document does not take the whole batch down.
+    ARGS:
+        job (tuple) - see iterBatchJobs
+    RETURNS:
+        tuple - (inputName, outputPath or None, error message or None)
+    """
+    inputName, url, sourceDocument, error, outDir, outputFilename, options = job
+    if error:
+        return (inputName, None, error)
+    try:
+        if sourceDocument is None:
+            with open(inputName, "rb") as inputFile:
+                sourceDocument = inputFile.read()
+        outputPath = generateEPUB(url, sourceDocument, outDir, outputFilename=outputFilename, **options)
+        return (inputName, outputPath, None)
+    except Exception, ex:
+        logging.debug(traceback.format_exc())
+        return (inputName, None, "%s: %s" % (ex.__class__.__name__, ex))
+
+
+def convertBatch(inputs, outDir, jobs=None, fetchEngine=None, **options):
+    """
+    Convert many input files/URLs using a pool of worker processes.
+    ARGS:
+        inputs (list[str]) - input file paths and URLs
+        outDir (str) - output directory
+        jobs (int) - number of worker processes (number of CPUs if not provided)
+        fetchEngine (FetchEngine) - used to download URLs (default settings if not provided)
+        options - passed to generateEPUB (includeDIV, includeIMG, ...), with archive inputs are URLs of documents
+                  in the archive
+    RETURNS:
+        list[tuple] - (input, outputPath, error) for each input, in the order of completion
+    """
+    jobs = min(jobs or multiprocessing.cpu_count(), len(inputs)) or 1
+    logging.info("Converting %d documents using %d worker processes", len(inputs), jobs)
 
+    results = []
+    pool = multiprocessing.Pool(processes=jobs)
     try:
-        documentData.parseDocument(sourceDocument, includeDIV=includeDIV, includeIMG=includeIMG, includeTables=includeTables)
-        initializePackageStructure(tmpDir)
-        generateTocNcx(tmpDir, documentData)
-        generateContentOpf(tmpDir, documentData)
-        generateContent(tmpDir, documentData)
-        generateCSS(tmpDir, documentData, extraCSS)
-        downloadImages(tmpDir, documentData)
-        allowedChars = ['_', '-', '!', ' ']
-        sanitizedTitle = filter(lambda ch: ch.isalpha() or ch.isdigit() or ch in allowedChars, documentData.title)
-        outputFilename = "%s_%s.epub" % (sanitizedTitle, documentData.shortDateString)
-        outputFilename = string.translate(outputFilename.encode("utf-8"), None, "?*:\\/|")
-        saveAsEPUB(tmpDir, outDir, outputFilename)
-        return os.path.join(outDir, outputFilename)
+        for inputName, outputPath, error in pool.imap_unordered(convertFileWorker,
+                                                                iterBatchJobs(inputs, outDir, options, fetchEngine)):
+            results.append((inputName, outputPath, error))
+            if error:
+                logging.error("[%d/%d] FAILED %s: %s", len(results), len(inputs), inputName, error)
+            else:
+                logging.info("[%d/%d] %s -> %s", len(results), len(inputs), inputName, outputPath)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
     finally:
-        # keep temporary files in debug mode
-        if not debug and os.path.exists(tmpDir):
-            logging.debug("Removing temp directory: %s", tmpDir)
-            shutil.rmtree(tmpDir, True)
+        pool.join()
+
+    failed = len([result for result in results if result[2]])
+    logging.info("Batch finished: %d converted, %d failed", len(results) - failed, failed)
+    return results
+
+
+FEED_MAX_ENTRIES = 20  # max. number of new feed entries converted in one run (the newest ones, older are skipped)
+FEED_MAX_SEEN = 1000  # max. number of entry ids remembered per feed
+FEED_MAX_ATTEMPTS = 3  # an entry failing to convert in this many runs is given up on (marked as seen)
+FEED_PERMANENT_ERROR_REGEXP = re.compile(r"^HTTPError: HTTP Error 4(?!08|29)\d\d\b")  # errors given up on at once
+
+
+class FeedEntry(object):
+    def __init__(self, entryId, url, title=None):
+        self.id = entryId  # <guid> (RSS) or <id> (Atom), the link if there is none
+        self.url = url
+        self.title = title
+
+
+def xmlLocalName(element):
+    return element.tag.rsplit("}", 1)[-1] if isinstance(element.tag, basestring) else None
+
+
+def parseFeed(feedDocument, feedUrl=None):
+    """
+    Read entries of an RSS (0.9x, 1.0, 2.0) or Atom feed.
+    ARGS:
+        feedDocument (str) - feed XML
+        feedUrl (str) - relative entry links are resolved against it
+    RETURNS:
+        list[FeedEntry] - entries with a link, in feed order (usually newest first)
+    RAISES:
+        ValueError - if the document is not a feed
+    """
+    if "<!ENTITY" in feedDocument:
+        raise ValueError("feeds with entity declarations are not supported")
+    try:
+        root = ElementTree.fromstring(feedDocument)
+    except ElementTree.ParseError, ex:
+        raise ValueError("invalid feed XML: %s" % ex)
+    if xmlLocalName(root) not in ("rss", "RDF", "feed"):
+        raise ValueError("not an RSS/Atom feed: <%s>" % xmlLocalName(root))
+    entries = []
+    for element in root.iter():
+        if xmlLocalName(element) not in ("item", "entry"):
+            continue
+        entryId = url = title = None
+        for child in element:
+            name = xmlLocalName(child)
+            text = (child.text or "").strip()
+            if name in ("guid", "id") and text:
+                entryId = text
+            elif name == "title":
+                title = text
+            elif name == "link":
+                if child.get("href"):
+                    # Atom: prefer the alternate (HTML) link
+                    if child.get("rel", "alternate") == "alternate" or url is None:
+                        url = child.get("href").strip()
+                elif text:
+                    url = text
+        if not url:
+            continue
+        if feedUrl:
+            url = urljoin(feedUrl, url)
+        entries.append(FeedEntry(entryId or url, url, title))
+    return entries
+
+
+class FeedState(object):
+    """
+    What is known about a feed from previous runs: ids of entries already converted (or given up on), number
+    of failed attempts of entries to retry and validators (ETag, Last-Modified) for the conditional request,
+    stored in <stateDir>/<sha1 of feed URL>.json.
+    """
+    def __init__(self, stateDir, feedUrl):
+        """
+        ARGS:
+            stateDir (str) - REPUB_HOME/feeds if not provided
+            feedUrl (str) - feed URL or path
+        """
+        self.stateDir = stateDir or os.path.join(REPUB_HOME, "feeds")
+        self.feedUrl = feedUrl
+        self.etag = None
+        self.lastModified = None
+        self.seen = []  # entry ids, most recent last
+        self.failures = {}  # entry id -> number of runs the entry failed to convert in
+        self.path = os.path.join(self.stateDir, hashlib.sha1(feedUrl).hexdigest() + ".json")
+        try:
+            with open(self.path, "rb") as stateFile:
+                state = json.load(stateFile)
+            self.etag = state.get("etag")
+            self.lastModified = state.get("lastModified")
+            self.seen = list(state.get("seen", []))
+            self.failures = dict(state.get("failures", {}))
+        except IOError:
+            pass
+        except (ValueError, AttributeError), ex:
+            logging.warn("Ignoring invalid feed state %s: %s", self.path, ex)
+
+    def save(self):
+        if not os.path.isdir(self.stateDir):
+            os.makedirs(self.stateDir)
+        tmpPath = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmpPath, "wb") as fileOut:
+            json.dump({"url": self.feedUrl, "etag": self.etag, "lastModified": self.lastModified,
+                       "seen": self.seen[-FEED_MAX_SEEN:], "failures": self.failures, "updatedAt": time.time()},
+                      fileOut)
+        os.rename(tmpPath, self.path)
+
+
+def fetchFeed(feedUrl, state, fetchEngine=None):
+    """
+    Download the feed unless it has not changed since the last run.
+    ARGS:
+        feedUrl (str) - feed URL or path
+        state (FeedState)
+    RETURNS:
+        tuple - (feed XML or None if not modified, {"etag": ..., "lastModified": ...} validators of the response)
+    """
+    if not isURL(feedUrl):
+        with open(feedUrl, "rb") as feedFile:
+            return feedFile.read(), {}
+    fetchEngine = fetchEngine or defaultFetchEngine()
+    if fetchEngine.cache and fetchEngine.cache.offline:
+        return fetchEngine.fetch(feedUrl).body, {}
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    if state.etag:
+        headers["If-None-Match"] = state.etag
+    if state.lastModified:
+        headers["If-Modified-Since"] = state.lastModified
+    response = fetchEngine.open(feedUrl, headers)
+    if response.status == 304:
+        response.read()
+        return None, {}
+    body = decodeContent(response.read(), response.headers.getheader("Content-Encoding"))
+    return body, {"etag": response.headers.getheader("ETag"),
+                  "lastModified": response.headers.getheader("Last-Modified")}
+
+
+def convertFeed(feedUrl, outDir, fetchEngine=None, stateDir=None, digestTitle=None, jobs=None,
+                maxEntries=FEED_MAX_ENTRIES, **options):
+    """
+    Convert entries added to the feed since the last run, each to its own book or all of them to a single
+    digest book. When the feed has not changed, it costs a single conditional request.
+    Entries that failed to convert are tried again in the next runs, up to FEED_MAX_ATTEMPTS times in total
+    (only once after permanent errors, see FEED_PERMANENT_ERROR_REGEXP).
+    ARGS:
+        feedUrl (str) - feed URL or path
+        outDir (str) - output directory
+        fetchEngine (FetchEngine) - used to download the feed and its entries
+        stateDir (str) - see FeedState
+        digestTitle (str) - put all new entries into one book with this title (see generateBundleEPUB)
+        jobs (int) - see convertBatch
+        maxEntries (int) - see FEED_MAX_ENTRIES
+        options - passed to convertBatch/generateBundleEPUB
+    RETURNS:
+        list[tuple] - (entry URL, outputPath, error) for each converted entry (one tuple for the digest book
+                      and one for each entry left out of it)
+    """
+    fetchEngine = fetchEngine or defaultFetchEngine()
+    state = FeedState(stateDir, feedUrl)
+    feedDocument, validators = fetchFeed(feedUrl, state, fetchEngine)
+    if feedDocument is None:
+        logging.info("Feed has not changed: %s", feedUrl)
+        return []
+    entries = parseFeed(feedDocument, feedUrl if isURL(feedUrl) else None)
+    if not isURL(feedUrl):
+        for entry in entries:
+            if not isURL(entry.url):
+                entry.url = os.path.join(os.path.dirname(feedUrl), entry.url)  # like in manifest files
+    seen = set(state.seen)
+    newEntries = []
+    for entry in entries:
+        if entry.id not in seen and entry.url not in [newEntry.url for newEntry in newEntries]:
+            newEntries.append(entry)
+    skippedEntries = newEntries[maxEntries:] if maxEntries else []
+    newEntries = newEntries[:maxEntries] if maxEntries else newEntries
+    newEntries.reverse()  # oldest first
+    logging.info("Feed %s: %d entries, %d new%s", feedUrl, len(entries), len(newEntries),
+                 ", %d older skipped" % len(skippedEntries) if skippedEntries else "")
+
+    results = []
+    if newEntries and digestTitle:
+        convertedUrls = set()
+        try:
+            outputPath, includedUrls = generateBundleEPUB([entry.url for entry in newEntries], outDir, digestTitle,
+                                                          fetchEngine=fetchEngine, **options)
+            results.append((feedUrl, outputPath, None))
+            convertedUrls.update(includedUrls)
+        except ValueError, ex:
+            results.append((feedUrl, None, str(ex)))
+        results.extend((entry.url, None, "not included in the digest") for entry in newEntries
+                       if results[0][1] and entry.url not in convertedUrls)
+    elif newEntries:
+        results = convertBatch([entry.url for entry in newEntries], outDir, jobs=jobs, fetchEngine=fetchEngine,
+                               **options)
+        convertedUrls = set(url for url, _, error in results if not error)
+    else:
+        convertedUrls = set()
+
+    state.seen.extend(entry.id for entry in skippedEntries)
+    errors = dict((url, error) for url, _, error in results if error)
+    failures, state.failures = state.failures, {}  # counts of entries which are not new any more are dropped
+    for entry in newEntries:
+        if entry.url in convertedUrls:
+            state.seen.append(entry.id)
+            continue
+        error = errors.get(entry.url) or ""
+        attempts = failures.get(entry.id, 0) + 1
+        if attempts >= FEED_MAX_ATTEMPTS or FEED_PERMANENT_ERROR_REGEXP.match(error):
+            logging.warn("Giving up on feed entry %s after %d failed attempt(s)", entry.url, attempts)
+            state.seen.append(entry.id)
+        else:
+            state.failures[entry.id] = attempts
+    if not state.failures:
+        # with entries to retry keep the old validators, so the feed is downloaded (and they are retried) next time
+        state.etag = validators.get("etag")
+        state.lastModified = validators.get("lastModified")
+    state.save()
+    return results
+
+
+SERVER_QUEUE_PER_WORKER = 4  # requests accepted per worker process, more are rejected with 503 until some finish
+SERVER_MAX_BODY_BYTES = 20 * 1024 * 1024  # max. size of HTML posted to the server
+SERVER_CONVERSION_TIMEOUT = 300  # seconds
+SERVER_LATENCY_SAMPLES = 1000  # percentiles in /metrics are computed from this many most recent requests
+
+_serverWorkerOptions = {}  # conversion options of a server worker process, set once when the process starts
+
+def initServerWorker(options):
+    global _serverWorkerOptions
+    _serverWorkerOptions = options
+
+
+def serverConversionWorker(job):
+    """
+    Convert one document in a warm server worker process.
+    ARGS:
+        job (tuple) - (url, sourceDocument, outDir, options overriding the server defaults)
+    RETURNS:
+        tuple - (outputPath, error message or None, {cache name: (hits, misses)} during this conversion)
+    """
+    url, sourceDocument, outDir, overrides = job
+    options = dict(_serverWorkerOptions)
+    options.update(overrides)
+    caches = [(name, options.get(option)) for name, option in (("images", "imageStore"), ("results", "resultCache"))
+              if options.get(option) is not None]
+    statsBefore = dict((name, cache.stats.snapshot()) for name, cache in caches)
+    try:
+        outputPath, error = generateEPUB(url, sourceDocument, outDir, **options), None
+    except Exception, ex:
+        logging.debug(traceback.format_exc())
+        outputPath, error = None, "%s: %s" % (ex.__class__.__name__, ex)
+    statsDelta = {}
+    for name, cache in caches:
+        hits, misses = cache.stats.snapshot()
+        statsDelta[name] = (hits - statsBefore[name][0], misses - statsBefore[name][1])
+    return outputPath, error, statsDelta
+
+
+class ServerMetrics(object):
+    """
+    Request counters and latencies of the conversion server.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.startTime = time.time()
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.inFlight = 0
+        self.latencies = collections.deque(maxlen=SERVER_LATENCY_SAMPLES)
+        self.cacheStats = {}  # cache name -> [hits, misses] reported by worker processes
+        self._lock = threading.Lock()
+
+    def addCacheStats(self, statsDelta):
+        with self._lock:
+            for name, (hits, misses) in statsDelta.items():
+                counters = self.cacheStats.setdefault(name, [0, 0])
+                counters[0] += hits
+                counters[1] += misses
+
+    def snapshot(self, httpCache=None):
+        """
+        RETURNS:
+            dict - metrics as served by /metrics
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            cacheStats = dict((name, tuple(counters)) for name, counters in self.cacheStats.items())
+            metrics = {
+                "uptime": round(time.time() - self.startTime, 1),
+                "requests": self.requests,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "inFlight": self.inFlight,
+                "queueDepth": max(0, self.inFlight - self.workers),
+                "workers": self.workers,
+            }
+        if httpCache is not None:
+            cacheStats["http"] = httpCache.stats.snapshot()
+        metrics["latency"] = dict(("p%d" % percent, round(latencies[min(len(latencies) - 1,
+                                                                          len(latencies) * percent / 100)], 3)
+                                   if latencies else None) for percent in (50, 90, 99))
+        metrics["latency"]["samples"] = len(latencies)
+        metrics["caches"] = dict((name, {"hits": hits, "misses": misses,
+                                         "hitRate": round(float(hits) / (hits + misses), 3) if hits + misses else None})
+                                 for name, (hits, misses) in cacheStats.items())
+        return metrics
+
+
+class ConversionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /convert?url=URL - download the page and send back the book
+    POST /convert[?url=URL] - convert HTML sent in the request body (url is used for metadata and images)
+    GET /metrics - JSON with request counters, latency percentiles, queue depth and cache hit rates
+    Options: div=1, img=1, tables=1 (see --div, --img, -t), defaults are taken from the command line.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.client_address[0], format % args)
+
+    def _sendBody(self, status, contentType, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _sendError(self, status, message, headers=None):
+        self._sendBody(status, "text/plain; charset=utf-8", "%s\n" % message, headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._sendBody(200, "application/json",
+                           json.dumps(self.server.metrics.snapshot(self.server.fetchEngine.cache), sort_keys=True))
+        elif path == "/convert":
+            self._convert(None)
+        else:
+            self._sendError(404, "not found")
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/convert":
+            self._sendError(404, "not found")
+            return
+        contentLength = self.headers.getheader("Content-Length", "")
+        if not contentLength.isdigit():
+            self._sendError(411, "Content-Length required")
+            return
+        if int(contentLength) > SERVER_MAX_BODY_BYTES:
+            self.close_connection = 1
+            self._sendError(413, "document too large (max. %d bytes)" % SERVER_MAX_BODY_BYTES)
+            return
+        self._convert(self.rfile.read(int(contentLength)))
+
+    def _convert(self, sourceDocument):
+        query = parse_qs(urlparse(self.path).query)
+        url = query.get("url", [None])[0]
+        if sourceDocument is None and not url:
+            self._sendError(400, "url parameter required")
+            return
+        if url and not isURL(url):
+            self._sendError(400, "invalid url: %s" % url)
+            return
+        overrides = dict((option, query[name][0] in ("1", "true", "yes"))
+                         for name, option in (("div", "includeDIV"), ("img", "includeIMG"), ("tables", "includeTables"))
+                         if name in query)
+
+        server = self.server
+        metrics = server.metrics
+        with metrics._lock:
+            metrics.requests += 1
+            if metrics.inFlight >= server.maxInFlight:
+                metrics.rejected += 1
+                rejected = True
+            else:
+                metrics.inFlight += 1
+                rejected = False
+        if rejected:
+            self._sendError(503, "server busy, try again later", {"Retry-After": "1"})
+            return
+
+        startTime = time.time()
+        outDir = None
+        status = 500
+        task = {"finished": False, "abandoned": False}  # abandoned - timed out, taskFinished releases the slot
+
+        def taskFinished(result):
+            with metrics._lock:
+                task["finished"] = True
+                abandoned = task["abandoned"]
+            if abandoned:
+                self._releaseSlot(outDir)
+
+        try:
+            try:
+                if sourceDocument is None:
+                    sourceDocument = server.fetchEngine.fetch(url).body
+                outDir = tempfile.mkdtemp(prefix="repub-", dir=server.workDir)
+                outputPath, error, statsDelta = server.pool.apply_async(
+                    serverConversionWorker, [(url, sourceDocument, outDir, overrides)],
+                    callback=taskFinished).get(SERVER_CONVERSION_TIMEOUT)
+                metrics.addCacheStats(statsDelta)
+            except urllib2.HTTPError, ex:
+                status, error = 502, "source URL returned HTTP %d" % ex.code
+            except (urllib2.URLError, socket.error, httplib.HTTPException, ValueError), ex:
+                status, error = 502, "could not download source URL: %s" % ex
+            except multiprocessing.TimeoutError:
+                status, error = 504, "conversion timed out"
+                with metrics._lock:
+                    # the worker is still busy with the document - keep it counted until it is done
+                    task["abandoned"] = not task["finished"]
+            if error:
+                with metrics._lock:
+                    metrics.failed += 1
+                self._sendError(status, error)
+                return
+            outputFilename = os.path.basename(outputPath)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/epub+zip")
+            self.send_header("Content-Length", str(os.path.getsize(outputPath)))
+            self.send_header("Content-Disposition", "attachment; filename=%s" %
+                             quoteattr(outputFilename.decode(sys.getfilesystemencoding() or "utf-8", "replace")
+                                       .encode("ascii", "replace")))
+            self.end_headers()
+            with open(outputPath, "rb") as bookFile:
+                for chunk in readChunks(bookFile):
+                    self.wfile.write(chunk)
+            with metrics._lock:
+                metrics.completed += 1
+                metrics.latencies.append(time.time() - startTime)
+        finally:
+            if not task["abandoned"]:
+                self._releaseSlot(outDir)
+
+    def _releaseSlot(self, outDir):
+        """
+        End of a conversion (or of a failed download), the book was sent or is not needed any more.
+        ARGS:
+            outDir (str) - directory the book was written to (None if not created yet)
+        """
+        with self.server.metrics._lock:
+            self.server.metrics.inFlight -= 1
+        if outDir:
+            shutil.rmtree(outDir, ignore_errors=True)
+
+
+class ConversionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Long running conversion service: requests are handled in threads, documents are converted in a pool of
+    worker processes started once, so no request pays for interpreter start-up and imports. Page downloads
+    share one FetchEngine (and its HTTP cache), images are shared through the image store.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fetchEngine, workers=None, workDir=None, **options):
+        """
+        ARGS:
+            address (tuple) - (host, port)
+            fetchEngine (FetchEngine) - used to download pages
+            workers (int) - number of worker processes (number of CPUs if not provided)
+            workDir (str) - books are written here before they are sent (system temp directory if not provided)
+            options - passed to generateEPUB (includeDIV, includeIMG, imageStore, ...)
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, ConversionRequestHandler)
+        self.fetchEngine = fetchEngine
+        self.workers = workers or multiprocessing.cpu_count()
+        self.maxInFlight = self.workers * SERVER_QUEUE_PER_WORKER
+        self.workDir = workDir
+        self.metrics = ServerMetrics(self.workers)
+        options = dict(options, debug=False)
+        self.pool = multiprocessing.Pool(processes=self.workers, initializer=initServerWorker, initargs=(options,))
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("-f", help="input file", action="store")
     parser.add_argument("-u", help="URL to input file", action="store")
+    parser.add_argument("-b", "--batch",
+                        help="batch mode: directory, glob pattern or manifest file (one path or URL per line) with input files",
+                        action="store")
+    parser.add_argument("--feed", help="RSS/Atom feed (URL or path): convert entries added since the last run",
+                        action="store")
+    parser.add_argument("--archive", help="WARC (.warc, .warc.gz) or MHTML file: convert documents stored in it, "
+                                          "images are taken from the archive", action="store")
+    parser.add_argument("--archive-filter", help="convert only archived documents with URLs matching this regular "
+                                                 "expression", action="store", metavar="REGEXP")
+    parser.add_argument("--archive-type", help="convert only archived documents of this content type (default: %s)"
+                                               % ARCHIVE_CONTENT_TYPE, action="store", default=ARCHIVE_CONTENT_TYPE,
+                        metavar="TYPE")
+    parser.add_argument("--serve", help="run conversion service: GET /convert?url=URL or POST HTML to /convert, "
+                                        "GET /metrics (workers: -j)", action="store", metavar="[HOST:]PORT")
+    parser.add_argument("--bundle", help="put all documents given with -b (or new --feed entries, or --archive "
+                                         "documents) into a single book with this title", action="store",
+                        metavar="TITLE")
+    parser.add_argument("-j", "--jobs", help="number of worker processes in batch mode (default: number of CPUs)",
+                        type=int, default=None)
+    parser.add_argument("--fetch-workers", help="number of concurrent downloads in batch mode (default: %d)" % FETCH_WORKERS,
+                        type=int, default=FETCH_WORKERS)
+    parser.add_argument("--host-connections",
+                        help="max. number of concurrent requests to a single host (default: %d)" % FETCH_PER_HOST_CONNECTIONS,
+                        type=int, default=FETCH_PER_HOST_CONNECTIONS)
+    parser.add_argument("--host-delay",
+                        help="min. number of seconds between requests to a single host (default: %s)" % FETCH_PER_HOST_DELAY,
+                        type=float, default=FETCH_PER_HOST_DELAY)
+    parser.add_argument("--cache-dir", help="directory with cached pages and images (default: %s)" % REPUB_HOME, default=REPUB_HOME)
+    parser.add_argument("--cache-size", help="max. size of the page cache (MB, 0 - no limit, default: %d)"
+                        % (HTTP_CACHE_MAX_BYTES / 1024 / 1024), type=int, default=HTTP_CACHE_MAX_BYTES / 1024 / 1024)
+    parser.add_argument("--img-store-size", help="max. size of stored images (MB, 0 - no limit, default: %d)"
+                        % (IMAGE_STORE_MAX_BYTES / 1024 / 1024), type=int, default=IMAGE_STORE_MAX_BYTES / 1024 / 1024)
+    parser.add_argument("--result-cache", help="reuse books converted before from unchanged documents with the same options",
+                        action="store_true", default=False)
+    parser.add_argument("--deterministic",
+                        help="same input gives identical book (identifier derived from the source, dates taken from "
+                             "SOURCE_DATE_EPOCH or fixed)", action="store_true", default=False)
+    parser.add_argument("--skip-boilerplate",
+                        help="skip paragraphs found in many documents from the same site (footers, etc.)",
+                        action="store_true", default=BOILERPLATE_FILTER)
+    parser.add_argument("--no-cache", help="always download pages, do not store them", action="store_true",
+                        default=False)
+    parser.add_argument("--no-img-store", help="always download images, do not store them", action="store_true",
+                        default=False)
+    parser.add_argument("--offline", help="use only cached pages and stored images, never go to the network",
+                        action="store_true", default=False)
     parser.add_argument("-o", help="output directory", action="store")
     parser.add_argument("--div",
                         help="include <div> tags (to use when a page uses <div> instead of <p> for paragraphs)",
                         action="store_true")
     parser.add_argument("--img", help="include images", action="store_true", default=False)
+    parser.add_argument("--img-max-size", help="skip images larger than this (KB, 0 - no limit, default: %d)" % (IMAGE_MAX_BYTES / 1024),
+                        type=int, default=IMAGE_MAX_BYTES / 1024)
+    parser.add_argument("--img-budget", help="max. total size of images in a book (KB, 0 - no limit, default: %d)" % (IMAGE_BUDGET_BYTES / 1024),
+                        type=int, default=IMAGE_BUDGET_BYTES / 1024)
+    parser.add_argument("--img-optimize",
+                        help="downscale images to the screen resolution, convert to grayscale and recompress (requires PIL)",
+                        action="store_true", default=False)
+    parser.add_argument("--img-resolution", help="screen resolution used by --img-optimize (default: %dx%d)" % DEVICE_RESOLUTION,
+                        default="%dx%d" % DEVICE_RESOLUTION)
+    parser.add_argument("--img-quality", help="JPEG quality used by --img-optimize (default: %d)" % IMAGE_JPEG_QUALITY,
+                        type=int, default=IMAGE_JPEG_QUALITY)
+    parser.add_argument("--zip-level", help="compression level for text parts of the book (0-9, default: %d)" % ZIP_COMPRESSION_LEVEL,
+                        type=int, choices=range(10), metavar="LEVEL", default=ZIP_COMPRESSION_LEVEL)
+    parser.add_argument("--chapter-size", help="split content into files of at most this size (KB, 0 - no splitting, default: %d)"
+                        % (CHAPTER_MAX_BYTES / 1024), type=int, default=CHAPTER_MAX_BYTES / 1024, metavar="SIZE")
+    parser.add_argument("--parser", help="HTML parser backend (default: %s - fastest one installed)" % PARSER_BACKEND,
+                        choices=["auto"] + PARSER_BACKENDS, default=PARSER_BACKEND)
+    parser.add_argument("--compare-parsers", help="convert input with every installed parser backend and compare times",
+                        action="store_true", default=False)
     parser.add_argument("-t", help="include tables (use with caution)", action="store_true", default=False)
     parser.add_argument("-d", help="debug mode", action="store_true", default=False)
     parser.add_argument("-v", help="verbose", action="store_true", default=False)
+    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
     args = parser.parse_args(sys.argv[1:])
     
     if not URL and len(sys.argv) < 2:
@@ -620,11 +4236,18 @@ if __name__ == "__main__":
     
     logging.basicConfig(format="%(message)s", level=logging.DEBUG if args.d or args.v else logging.INFO)
     
-    if args.f and args.u:
-        logging.error("-f and -u options cannot be used together (ambiguous source)")
+    if len(filter(None, [args.f, args.u, args.batch, args.feed, args.serve, args.archive])) > 1:
+        logging.error("-f, -u, -b, --feed, --archive and --serve options cannot be used together (ambiguous source)")
         sys.exit(1)
     
-    if not args.f and not args.u:
+    if args.bundle and not args.batch and not args.feed and not args.archive:
+        logging.error("--bundle requires a list of documents (-b, --feed or --archive)")
+        sys.exit(1)
+
+    if args.serve and not args.o:
+        args.o = tempfile.gettempdir()  # books are sent to clients, only temporary files are written
+
+    if not args.f and not args.u and not args.batch and not args.feed and not args.serve and not args.archive:
         if URL:
             args.u = URL
             logging.warn("Using build in URL: %s", URL)
@@ -642,28 +4265,144 @@ if __name__ == "__main__":
         logging.error("given output path is incorrect")
         sys.exit(1)
     
+    try:
+        deviceResolution = tuple(int(size) for size in args.img_resolution.lower().split("x"))
+        if len(deviceResolution) != 2:
+            raise ValueError
+    except ValueError:
+        logging.error("invalid screen resolution: %s (expected WIDTHxHEIGHT)", args.img_resolution)
+        sys.exit(1)
+
+    conversionOptions = dict(includeDIV=INCLUDE_DIV or args.div,
+                             includeIMG=INCLUDE_IMAGES or args.img,
+                             includeTables=INCLUDE_TABLES or args.t,
+                             extraCSS=EXTRA_CSS,
+                             debug=args.d,
+                             imageMaxBytes=args.img_max_size * 1024 or None,
+                             imageBudgetBytes=args.img_budget * 1024 or None,
+                             optimizeIMG=args.img_optimize,
+                             deviceResolution=deviceResolution,
+                             jpegQuality=args.img_quality,
+                             compressionLevel=args.zip_level,
+                             parserBackend=args.parser,
+                             maxChapterBytes=args.chapter_size * 1024,
+                             deterministic=DETERMINISTIC_BUILD or args.deterministic)
+
+    httpCache = None
+    if (HTTP_CACHE_ENABLED and not args.no_cache) or args.offline:
+        httpCache = HTTPCache(os.path.join(args.cache_dir, "http"), maxBytes=args.cache_size * 1024 * 1024 or None,
+                              offline=args.offline)
+    if (IMAGE_STORE_ENABLED and not args.no_img_store) or args.offline:
+        conversionOptions["imageStore"] = ImageStore(os.path.join(args.cache_dir, "images"),
+                                                     maxBytes=args.img_store_size * 1024 * 1024 or None,
+                                                     offline=args.offline)
+    if args.skip_boilerplate:
+        conversionOptions["boilerplateIndex"] = BoilerplateIndex(os.path.join(args.cache_dir, "boilerplate"))
+    if args.result_cache and not args.bundle:
+        conversionOptions["resultCache"] = ResultCache(os.path.join(args.cache_dir, "results"))
+    fetchEngine = FetchEngine(workers=args.fetch_workers,
+                              perHostConnections=args.host_connections,
+                              perHostDelay=args.host_delay,
+                              cache=httpCache)
+
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        try:
+            server = ConversionServer((host or "127.0.0.1", int(port)), fetchEngine, workers=args.jobs, workDir=args.o,
+                                      **conversionOptions)
+        except (ValueError, socket.error), ex:
+            logging.error("Could not start server on %s: %s", args.serve, ex)
+            sys.exit(1)
+        logging.info("Serving on http://%s:%d/ with %d worker processes", server.server_address[0],
+                     server.server_address[1], server.workers)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # stop cleanly when run as a service
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        sys.exit(0)
+
+    if args.archive:
+        try:
+            archive = openArchive(args.archive)
+            records = selectArchiveRecords(archive, args.archive_filter, args.archive_type)
+        except (ValueError, IOError, re.error), ex:
+            logging.error("Could not read archive %s: %s", args.archive, ex)
+            sys.exit(1)
+        logging.info("Archive %s: %d documents, %d selected", args.archive, len(archive.records), len(records))
+        if not records:
+            logging.error("no documents selected in the archive")
+            sys.exit(1)
+        archiveUrls = [record.url for record in records]
+        conversionOptions["archive"] = archive
+        if args.bundle:
+            try:
+                _, includedUrls = generateBundleEPUB(archiveUrls, args.o,
+                                                     args.bundle.decode(sys.getfilesystemencoding() or "utf-8"),
+                                                     fetchEngine=fetchEngine, **conversionOptions)
+            except ValueError, ex:
+                logging.error("%s", ex)
+                sys.exit(1)
+            sys.exit(1 if len(includedUrls) < len(archiveUrls) else 0)
+        batchResults = convertBatch(archiveUrls, args.o, jobs=args.jobs, fetchEngine=fetchEngine, **conversionOptions)
+        sys.exit(1 if [result for result in batchResults if result[2]] else 0)
+
+    if args.feed:
+        try:
+            feedResults = convertFeed(args.feed, args.o, fetchEngine=fetchEngine,
+                                      stateDir=os.path.join(args.cache_dir, "feeds"),
+                                      digestTitle=args.bundle.decode(sys.getfilesystemencoding() or "utf-8")
+                                      if args.bundle else None, jobs=args.jobs, **conversionOptions)
+        except (ValueError, IOError, urllib2.URLError), ex:
+            logging.error("Could not read feed %s: %s", args.feed, ex)
+            sys.exit(1)
+        sys.exit(1 if [result for result in feedResults if result[2]] else 0)
+
+    if args.batch:
+        batchInputs = collectBatchInputs(args.batch)
+        if not batchInputs:
+            logging.error("no input files found: %s", args.batch)
+            sys.exit(1)
+        if args.bundle:
+            try:
+                _, includedInputs = generateBundleEPUB(batchInputs, args.o,
+                                                       args.bundle.decode(sys.getfilesystemencoding() or "utf-8"),
+                                                       fetchEngine=fetchEngine, **conversionOptions)
+            except ValueError, ex:
+                logging.error("%s", ex)
+                sys.exit(1)
+            sys.exit(1 if len(includedInputs) < len(batchInputs) else 0)
+        batchResults = convertBatch(batchInputs, args.o, jobs=args.jobs, fetchEngine=fetchEngine, **conversionOptions)
+        sys.exit(1 if [result for result in batchResults if result[2]] else 0)
+    
     try:
         if args.f:
             with open(args.f, "rb") as inputFile:
                 sourceDocument = inputFile.read()
         else:
-            sourceDocument = downloadWebPageSource(args.u)
+            sourceDocument = downloadWebPageSource(args.u, fetchEngine)
     except urllib2.HTTPError as e:
         logging.error("Failed to open source URL (%d): %s", e.code, 
                           BaseHTTPServer.BaseHTTPRequestHandler.responses.get(e.code, "Unknown error"))
         sys.exit(1)
     except Exception, ex:
-        logging.error("Error opening source document: %s", ex.message)
+        logging.error("Error opening source document: %s", ex)
         sys.exit(1)
         
+    if args.compare_parsers:
+        for backend, bestTime, paragraphCount, textLength in compareParserBackends(sourceDocument, args.u,
+                                                                                   includeDIV=conversionOptions["includeDIV"],
+                                                                                   includeIMG=conversionOptions["includeIMG"],
+                                                                                   includeTables=conversionOptions["includeTables"]):
+            print "%-12s %8.3fs %6d paragraphs %9d characters" % (backend, bestTime, paragraphCount, textLength)
+        sys.exit(0)
+
     generateEPUB(args.u,  # url
                  sourceDocument,
                  args.o,  # outDir
-                 includeDIV=INCLUDE_DIV or args.div,
-                 includeIMG=INCLUDE_IMAGES or args.img,
-                 includeTables=INCLUDE_TABLES or args.t,
-                 extraCSS=EXTRA_CSS,
-                 debug=args.d)
+                 **conversionOptions)
 
 
 # The MIT License (MIT)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of repub.py, run with:
+
+    python -m unittest discover tests
+"""
+import sys
+import os
+import datetime
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import httplib
+import logging
+import multiprocessing
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import repub
+
+PNG_IMAGE = ("\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89"
+             "\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82")
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix="repub-test-")
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def patch(self, owner, attrName, value):
+        original = getattr(owner, attrName)
+        setattr(owner, attrName, value)
+        self.addCleanup(setattr, owner, attrName, original)
+
+
+class WriteDocumentContentTest(TemporaryDirectoryTestCase):
+    def testOptimizeImagesWithoutPIL(self):
+        self.patch(repub, "Image", None)
+        self.patch(repub, "downloadImages", lambda documentData, **kwargs: dict(
+            (localName, StringIO.StringIO(PNG_IMAGE)) for localName, url in documentData.images))
+        documentData = repub.DocumentData("http://example.com/article")
+        contentBlocks = repub.extractDocument(documentData, '<html><body><p>Text</p><img src="/a.png"></body></html>',
+                                              includeIMG=True)
+        package = repub.DirectoryPackage(self.tmpDir)
+        chapters, mediaTypes = repub.writeDocumentContent(package, documentData, contentBlocks, optimizeIMG=True)
+        self.assertEqual(mediaTypes, {documentData.images[0][0]: "image/png"})
+        with open(os.path.join(self.tmpDir, "OEBPS", "img", documentData.images[0][0]), "rb") as imgFile:
+            self.assertEqual(imgFile.read(), PNG_IMAGE)
+
+
+class ContentScoresTest(unittest.TestCase):
+    def testNestedParagraphsCountedOnce(self):
+        soup = repub.bs4.BeautifulSoup("<body><div><blockquote><p>%s</p></blockquote></div><div><p>%s</p></div></body>"
+                                       % ("x" * 100, "y" * 120), "html.parser")
+        scores = repub.ContentScores(soup)
+        self.assertEqual(scores.subtreeParagraphTextLength[id(soup)], 220)
+        self.assertEqual(scores.subtreeParagraphTextLength[id(soup.div)], 100)
+
+
+def recordDocuments(boilerplateIndex, worker, count):
+    for i in range(count):
+        boilerplateIndex.record("example.com", "%d-%d" % (worker, i), set(["footer"]))
+
+
+class BoilerplateIndexTest(TemporaryDirectoryTestCase):
+    def testConcurrentProcessesKeepAllDocuments(self):
+        boilerplateIndex = repub.BoilerplateIndex(self.tmpDir)
+        workers = [multiprocessing.Process(target=recordDocuments, args=(boilerplateIndex, worker, 25))
+                   for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        site = boilerplateIndex._readSite("example.com")
+        self.assertEqual(len(site["documents"]), 100)
+        self.assertEqual(site["blocks"]["footer"][0], 100)
+
+
+class ConvertFeedTest(TemporaryDirectoryTestCase):
+    def testFailingEntryGivenUpOnAfterMaxAttempts(self):
+        feedPath = os.path.join(self.tmpDir, "feed.xml")
+        with open(feedPath, "wb") as feedFile:
+            feedFile.write('<rss version="2.0"><channel><title>Feed</title>'
+                           '<item><guid>missing</guid><link>missing.html</link></item></channel></rss>')
+        stateDir = os.path.join(self.tmpDir, "feeds")
+        for attempt in range(1, repub.FEED_MAX_ATTEMPTS + 1):
+            results = repub.convertFeed(feedPath, self.tmpDir, stateDir=stateDir, jobs=1)
+            self.assertEqual(len(results), 1)
+            state = repub.FeedState(stateDir, feedPath)
+            if attempt < repub.FEED_MAX_ATTEMPTS:
+                self.assertEqual((state.seen, state.failures), ([], {"missing": attempt}))
+        self.assertEqual((state.seen, state.failures), (["missing"], {}))
+        self.assertEqual(repub.convertFeed(feedPath, self.tmpDir, stateDir=stateDir, jobs=1), [])
+
+
+def slowConversionWorker(job):
+    url, sourceDocument, outDir, overrides = job
+    time.sleep(1)
+    outputPath = os.path.join(outDir, "book.epub")
+    with open(outputPath, "wb") as bookFile:
+        bookFile.write(sourceDocument)
+    return outputPath, None, {}
+
+
+class ConversionServerTest(TemporaryDirectoryTestCase):
+    def testTimedOutConversionKeepsSlotUntilDone(self):
+        self.patch(repub, "SERVER_CONVERSION_TIMEOUT", 0.2)
+        self.patch(repub, "serverConversionWorker", slowConversionWorker)
+        server = repub.ConversionServer(("127.0.0.1", 0), repub.FetchEngine(), workers=1, workDir=self.tmpDir)
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.start()
+        try:
+            connection = httplib.HTTPConnection("127.0.0.1", server.server_address[1])
+            connection.request("POST", "/convert", "<html><body><p>Text</p></body></html>")
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            self.assertEqual(response.status, 504)
+            self.assertEqual(server.metrics.inFlight, 1)
+            self.assertEqual(len(os.listdir(self.tmpDir)), 1)
+            deadline = time.time() + 10
+            while server.metrics.inFlight and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(server.metrics.inFlight, 0)
+            self.assertEqual(os.listdir(self.tmpDir), [])
+        finally:
+            server.shutdown()
+            serverThread.join()
+            server.server_close()
+
+
+class DefaultOutputFilenameTest(unittest.TestCase):
+    def testDeterministicModeUsesRealDate(self):
+        documentData = repub.DocumentData(deterministic=True)
+        documentData.title = "Title"
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        self.assertEqual(repub.defaultOutputFilename(documentData), "Title_%s.epub" % today)
+        self.assertEqual(documentData.shortDateString, repub.buildTimestamp().strftime("%Y-%m-%d"))
+
+
+if __name__ == "__main__":
+    unittest.main()